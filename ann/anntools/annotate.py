@@ -32,8 +32,13 @@
 #
 ################################################################################
 
+import bloomfilter
 import file_utils as fu
+import intervals
+import lookupcache
+import profiling
 import sql_config
+import transcripts
 import utils as u
 
 
@@ -68,6 +73,17 @@ def collapseRefSeq(line):
 
     return  ';'.join(collapsed)
 
+# Columns of the bigRefGene tables after bin, as collapseRefSeq names them
+refSeqNames=['chr','start','end','haplotypeReference','haplotypeAlternate','name','name2','transcriptStrand','positionType','frame','mrnaCoord','codonCoord','spliceDist','referenceCodon','referenceAA','variantCodon','variantAA','changesAA','functionalClass','codingCoordStr','proteinCoordStr','inCodingRegion','spliceInfo','uorfChange']
+
+def refSeqRecord(row):
+    """ collapseRefSeq of a bigRefGene row, without joining the row into a line and splitting it again """
+    values=[str(x) for x in row[1:]]
+    if values[0] != values[0].lstrip() or values[-1] != values[-1].rstrip() or any(['\t' in v for v in values]):
+        ## the line would not split back into the same columns
+        return collapseRefSeq('\t'.join(values))
+    return ';'.join([refSeqNames[i]+'='+values[i].strip() for i in range(5, len(values)) if len(values[i]) > 0 and values[i] != '0'])
+
 
 def binarySearchUniqueAndSorted(arg0, key):
     low = 0;
@@ -147,84 +163,683 @@ def dbsnpsql(chr, pos, ref, alt, vc):
 
 
 
-"""" format must be pileup or vcf """
-""" Types of variants in dbSNP135: DIV, SNV,    MNV,   MIXED  """
 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='SNV', sep='\t'):
-    outfile = vcf+tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile=vcf+'.count.log'
-    fh_log = open(logcountfile, 'w')
+""" Helper methods to normalize chromosome names, some tables use "1" and others "chr1" """
+def stripChrPrefix(chr):
+    if(chr.startswith("chr")==True):
+        chr = chr.replace('chr', '')
+    return chr
+
+def addChrPrefix(chr):
+    if(chr.startswith("chr")==False):
+        chr = "chr" + chr
+    return chr
+
+""" Helper method to tell header lines from variant lines """
+def isHeader(line):
+    if isinstance(line, bytes):
+        return line.startswith(b'#') or line.startswith(b'CHROM')
+    return line.startswith('#') or line.startswith('CHROM')
+
+""" First of the rows, or None - what fetchone would return """
+def firstRow(rows):
+    if len(rows) > 0:
+        return rows[0]
+    return None
+
+""" Helper method to compare values the way MySQL does: case-insensitive, ignoring trailing spaces """
+def sqlKey(value):
+    return str(value).upper().rstrip(' ')
+
+# Columns split off a variant line, CHROM to INFO; the rest of the line is kept as one string
+VARIANT_COLUMNS = 8
+
+class Variant(object):
+    """ One variant line, parsed once when it is read.
+
+        The stages used to strip, clean and int() the same columns of the split
+        line over and over, and rebuild INFO as a new string with every record
+        they added. A Variant keeps the columns in fields, with the chromosome as
+        written (chrom), without and with the chr prefix (chromKey, chromName),
+        the position as text and int, and the cleaned REF and ALT. INFO is a
+        list of the pieces the stages add, joined only when a stage reads it
+        back or the line is written. Indexing a Variant reads and writes the
+        columns as indexing the split line did, with INFO at index 7.
+
+        Only the first VARIANT_COLUMNS columns are split. FORMAT and the sample
+        columns, thousands of them in cohort VCFs, are never read by the stages:
+        they stay one unsplit string, the last item of fields, and are written
+        back as they were read.
+    """
+    __slots__ = ('fields', 'info', 'chrom', 'chromKey', 'chromName', 'posText', 'pos', 'ref', 'alt')
+    tab = '\t'
+
+    def __init__(self, fields, inds):
+        self.fields = fields
+        self.info = [fields[7]] if len(fields) > 7 else None
+        self.setLocus(fields[inds[0]], fields[inds[1]], fields[inds[2]], fields[inds[3]])
+
+    def setLocus(self, chrom, pos, ref, alt):
+        self.chrom = chrom.strip()
+        self.chromKey = stripChrPrefix(self.chrom)
+        self.chromName = addChrPrefix(self.chrom)
+        self.posText = pos.strip()
+        self.pos = int(self.posText)
+        self.ref = clean_shit(ref).strip()
+        self.alt = clean_shit(alt).strip()
+
+    def __getitem__(self, i):
+        if i == 7:
+            return self.getInfo()
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        if i == 7:
+            self.info = [value]
+        else:
+            self.fields[i] = value
+
+    def joinInfo(self):
+        if len(self.info) > 1:
+            self.info = [self.info[0][:0].join(self.info)]
+        return self.info[0]
+
+    def getInfo(self):
+        return self.joinInfo()
+
+    def addInfo(self, text):
+        self.info.append(text)
+
+    def infoEndsWith(self, suffix):
+        ## a suffix longer than the last part may span the parts before it
+        if len(self.info[-1]) >= len(suffix):
+            return self.info[-1].endswith(suffix)
+        return self.joinInfo().endswith(suffix)
+
+    def infoStartsWith(self, prefix):
+        if len(self.info[0]) >= len(prefix):
+            return self.info[0].startswith(prefix)
+        return self.joinInfo().startswith(prefix)
+
+    def line(self):
+        """ The line as written out, INFO joined once """
+        if self.info is None:
+            return self.tab.join(self.fields)
+        return self.tab.join(self.fields[:7] + [self.joinInfo()] + self.fields[8:])
+
+
+class BinaryVariant(Variant):
+    """ A Variant read from a binary file: the columns, INFO and the sample columns stay bytes.
+
+        Only CHROM, POS, REF and ALT, which go into the queries, are decoded.
+        The records the stages add to INFO are encoded as they are added, so the
+        line is written back without decoding or encoding the rest of it. Indexing
+        still reads and writes text, for the few places that read INFO back.
+    """
+    __slots__ = ()
+    tab = b'\t'
+
+    def setLocus(self, chrom, pos, ref, alt):
+        Variant.setLocus(self, chrom.decode('utf-8'), pos.decode('utf-8'), ref.decode('utf-8'), alt.decode('utf-8'))
+
+    def __getitem__(self, i):
+        if i == 7:
+            return self.getInfo()
+        return self.fields[i].decode('utf-8')
+
+    def __setitem__(self, i, value):
+        Variant.__setitem__(self, i, value.encode('utf-8'))
+
+    def getInfo(self):
+        return self.joinInfo().decode('utf-8')
+
+    def addInfo(self, text):
+        self.info.append(text.encode('utf-8'))
+
+    def infoEndsWith(self, suffix):
+        return Variant.infoEndsWith(self, suffix.encode('utf-8'))
+
+    def infoStartsWith(self, prefix):
+        return Variant.infoStartsWith(self, prefix.encode('utf-8'))
+
+
+""" Reads a VCF in batches of up to batchsize variants. Header lines are kept as strings, variants as Variants.
+    A binary file handle is read with binary=True: header lines are then kept as bytes, variants as BinaryVariants """
+def readBatches(fh, batchsize, sep='\t', inds=None, binary=False):
+    if inds is None:
+        inds = getFormatSpecificIndices()
+    variant = Variant
+    if binary:
+        sep = sep.encode('utf-8')
+        variant = BinaryVariant
+    batch=[]
     var_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
-
     for line in fh:
         line = line.strip()
-        if line.startswith("#")==False:
-            fields=line.split(sep)
-            chr=fields[inds[0]].strip()
-            if(chr.startswith("chr")==True):
-                chr = chr.replace('chr', '')
+        if isHeader(line):
+            batch.append(line)
+        else:
+            batch.append(variant(line.split(sep, VARIANT_COLUMNS), inds))
+            var_count=var_count+1
+            if var_count >= batchsize:
+                yield batch
+                batch=[]
+                var_count=0
+    if len(batch) > 0:
+        yield batch
+
+""" Helper method to write a batch back out, as text or bytes as it was read """
+def writeBatch(fh_out, batch):
+    for item in batch:
+        if isinstance(item, Variant):
+            item = item.line()
+        if isinstance(item, bytes):
+            fh_out.write(item+b'\n')
+        else:
+            fh_out.write(item+'\n')
 
-            pos=fields[inds[1]].strip()
-            ref=clean_shit(fields[inds[2]]).strip()
-            alt=clean_shit(fields[inds[3]]).strip()
+""" Variants of a batch, without the header lines """
+def batchVariants(batch):
+    return [item for item in batch if isinstance(item, Variant)]
 
-            compRef=getComplementary(ref)
-            compAlt=getComplementary(alt)
+""" Helper method to append records to INFO, skipping the separator if INFO already ends with one """
+def appendInfo(variant, records):
+    if variant.infoEndsWith(';'):
+        variant.addInfo(records)
+    else:
+        variant.addInfo(';'+records)
 
-            #sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( (  REF="'+ str(ref) + '" AND ALT ="'+ str(alt)+'")  OR (REF="'+ str(compRef) + '" AND ALT ="'+ str(compAlt)+'" )) ;'
-            sql='select * from dbSNP where CHR="'+ str(chr) + '" AND POS=' + str(pos) + ' AND ( REF="'+ str(ref) + '" OR REF ="'+ str(compRef)+'" )  AND INFO = "'+varclass+'" ;'
-            cursor.execute (sql)
-            rows = cursor.fetchall ()
-            fields[2]='.'
-            rsids=[]
-            mafs=[]
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) !='.':
-                        mafs.append('GMAF='+str(row[7]))
 
-                maf_str=''
-                if len(mafs)>0:
-                    maf_str=';'+';'.join([str(x) for x in mafs])
+# Bloom filters (bloomfilter.py) that answer definite misses of the exact-match lookups, see useBloomFilters
+bloomFilters = None
 
+""" Skips the lookups the Bloom filters at path rule out from now on, or none with None.
+    Filters built from another reference than the one in use are not used """
+def useBloomFilters(path):
+    global bloomFilters
+    bloomFilters = None
+    if path is not None:
+        filters = bloomfilter.openFilters(path)
+        if filters.source != sql_config.referenceStamp():
+            print('Not using the Bloom filters in ' + str(path) + ', they were built from ' + str(filters.source))
+        else:
+            bloomFilters = filters
+
+
+class Stage(object):
+    """ One annotation step of the pipeline.
+
+        lookup() queries the database for one variant (an annotate.Variant), apply()
+        writes the result into the variant and updates the counters, report() writes the
+        counters to the .count.log; counters()/addCounters() carry them across
+        processes when a job is split into shards. A stage can be handed a shared connection,
+        otherwise it takes its own from the pool. preload() lets a stage load its table into
+        memory when the job is large enough to make that pay off, sweep() lets
+        it merge-join its table with coordinate-sorted input.
+
+        reads and writes name the VCF columns and INFO keys the stage reads and
+        writes, which tells the scheduler which stages can be looked up at the
+        same time. lookup() must not modify the variant; apply() runs in the
+        main thread in pipeline order.
+
+        Lookups run statements built once per stage with %s placeholders, and
+        the variant values are passed as parameters. Only table and column
+        names, which come from the stage itself, are part of the statement text.
+
+        cachedLookupBatch() puts the per-table LRU cache (lookupcache.py) in
+        front of lookupBatch() for stages that query, keyed by cacheKey().
+        Its hits, misses and evictions go to the .count.log.
+
+        Exact-match lookups ask filterNegative() first, and skip the query when
+        the table's Bloom filter rules out every key. The lookups skipped per
+        table go to the .count.log.
+
+        cachedLookupBatch() and applyBatch() record the time, variants, queries
+        and rows of the stage in its profile (profiling.py), which goes to the
+        .count.log and the .metrics.json.
+    """
+    table = None
+    counted = ()
+    reads = ('CHROM', 'POS')
+    writes = ('INFO',)
+
+    def __init__(self, format='vcf'):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.conn = None
+        self.cursor = None
+        self.ownsConn = False
+        self.cache = None
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.cacheEvictions = 0
+        self.filterCounts = {}
+        self.profile = profiling.StageProfile()
+
+    def open(self, conn=None):
+        self.ownsConn = conn is None
+        if conn is None:
+            conn = sql_config.acquire()
+        ## every query of the stage goes through the profile, preloads included
+        self.conn = profiling.ProfiledConnection(conn, self.profile)
+        self.cursor = self.conn.cursor ()
+        self.cache = lookupcache.getCache(self.cacheName())
+
+    def preload(self):
+        pass
+
+    def sweep(self):
+        pass
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+        if self.ownsConn and self.conn is not None:
+            sql_config.release(self.conn.conn)
+        self.conn = None
+        self.cursor = None
+
+    def lookup(self, fields):
+        return None
+
+    def apply(self, fields, result):
+        pass
+
+    def annotate(self, fields):
+        self.apply(fields, self.lookup(fields))
+
+    def lookupBatch(self, batch):
+        return [self.lookup(fields) for fields in batch]
+
+    def cacheName(self):
+        return self.table
+
+    def cacheKey(self, fields):
+        """ Everything lookup() depends on """
+        return (fields.chrom, fields.posText)
+
+    def cacheWeight(self, result):
+        if result is None:
+            return 1
+        return 1 + len(result)
+
+    def inMemory(self):
+        """ True when lookups are answered without querying, which needs no cache """
+        return False
+
+    def cachedLookupBatch(self, batch):
+        started = self.profile.start()
+        if self.cache is None or self.inMemory():
+            results = self.lookupBatch(batch)
+        else:
+            results = self.lookupThroughCache(batch)
+        self.profile.stop(started)
+        return results
+
+    def lookupThroughCache(self, batch):
+        results = [None] * len(batch)
+        missing = {}
+        for i, fields in enumerate(batch):
+            key = self.cacheKey(fields)
+            result = self.cache.get(key)
+            if result is lookupcache.MISSING:
+                missing.setdefault(key, []).append(i)
+            else:
+                results[i] = result
+                self.cacheHits = self.cacheHits + 1
+
+        if len(missing) > 0:
+            keys = list(missing.keys())
+            found = self.lookupBatch([batch[missing[key][0]] for key in keys])
+            for key, result in zip(keys, found):
+                for i in missing[key]:
+                    results[i] = result
+                ## a locus repeated within the batch is looked up once
+                self.cacheMisses = self.cacheMisses + 1
+                self.cacheHits = self.cacheHits + len(missing[key]) - 1
+                self.cacheEvictions = self.cacheEvictions + self.cache.put(key, result, self.cacheWeight(result))
+        return results
+
+    def filterNegative(self, table, keys):
+        """ True when the Bloom filter of table rules out all the keys, so its query can be skipped """
+        filter = bloomFilters.get(table) if bloomFilters is not None else None
+        if filter is None:
+            return False
+        counts = self.filterCounts.setdefault(table, [0, 0])
+        counts[0] = counts[0] + 1
+        for key in keys:
+            if filter.mightContain(bloomfilter.filterKey(key)):
+                return False
+        counts[1] = counts[1] + 1
+        return True
+
+    def applyBatch(self, batch, results):
+        started = self.profile.start()
+        for fields, result in zip(batch, results):
+            self.apply(fields, result)
+        self.profile.variants = self.profile.variants + len(batch)
+        self.profile.stop(started)
+
+    def annotateBatch(self, batch):
+        self.applyBatch(batch, self.cachedLookupBatch(batch))
+
+    def report(self, fh_log):
+        pass
+
+    def reportCache(self, fh_log):
+        lookups = self.cacheHits + self.cacheMisses
+        if lookups > 0:
+            hitRate = (self.cacheHits/float(lookups))*100
+            fh_log.write("Cache " + str(self.cacheName()) + ": " + str(self.cacheHits) + " hits, " + str(self.cacheMisses) + " misses, " + str(self.cacheEvictions) + " evictions (" + str(round(hitRate, 1)) + "% hits)\n")
+
+    def reportFilters(self, fh_log):
+        for table in sorted(self.filterCounts):
+            checked, skipped = self.filterCounts[table]
+            skipRate = (skipped/float(checked))*100
+            fh_log.write("Bloom filter " + str(table) + ": " + str(skipped) + " of " + str(checked) + " lookups skipped (" + str(round(skipRate, 1)) + "%)\n")
+
+    def reportProfile(self, fh_log):
+        fh_log.write(profiling.stageLine(self.cacheName(), self.profile, self.cacheHits))
+
+    def metrics(self):
+        """ The profile of the stage as it goes into the .metrics.json """
+        profile = self.profile
+        return {'stage': str(self.cacheName()), 'wallTime': profile.wallTime, 'cpuTime': profile.cpuTime, 'variants': profile.variants,
+                'queries': profile.queries, 'rows': profile.rows, 'cacheHits': self.cacheHits, 'cacheMisses': self.cacheMisses,
+                'filterSkips': sum([counts[1] for counts in self.filterCounts.values()]),
+                'bytesRead': profile.bytesRead, 'bytesWritten': profile.bytesWritten,
+                'variantsPerSecond': profiling.rate(profile.variants, profile.wallTime)}
+
+    def counters(self):
+        counters = dict([(name, getattr(self, name)) for name in self.counted])
+        counters['cache'] = (self.cacheHits, self.cacheMisses, self.cacheEvictions)
+        counters['filters'] = dict([(table, tuple(counts)) for table, counts in self.filterCounts.items()])
+        counters['profile'] = self.profile.counters()
+        return counters
+
+    def addCounters(self, counters):
+        for name in self.counted:
+            setattr(self, name, getattr(self, name) + counters[name])
+        self.addCacheCounters(counters)
+
+    def addCacheCounters(self, counters):
+        hits, misses, evictions = counters['cache']
+        self.cacheHits = self.cacheHits + hits
+        self.cacheMisses = self.cacheMisses + misses
+        self.cacheEvictions = self.cacheEvictions + evictions
+        for table, (checked, skipped) in counters['filters'].items():
+            counts = self.filterCounts.setdefault(table, [0, 0])
+            counts[0] = counts[0] + checked
+            counts[1] = counts[1] + skipped
+        self.profile.addCounters(counters['profile'])
+
+
+class OverlapStage(Stage):
+    """ Base for the overlap stages, which count matched records and matched variants.
+
+        Stages over a table of [chromStart, chromEnd] intervals set indexable, and
+        answer lookups from an in-memory IntervalIndex once preloaded, or from a
+        SweepJoin while the input stays sorted. Otherwise they query per variant.
+        Preloaded, a batch is resolved per chromosome with IntervalIndex.stabBatch.
+        Stages that set single keep only the first overlapping row, as fetchone does.
+    """
+    label = None
+    counted = ('var_count', 'line_count')
+    indexable = False
+    single = False
+    chromCol = 'chrom'
+    startCol = 'chromStart'
+    endCol = 'chromEnd'
+
+    def __init__(self, format='vcf', table=None):
+        Stage.__init__(self, format=format)
+        if table is not None:
+            self.table = table
+        self.var_count = 0
+        self.line_count = 0
+        self.index = None
+        self.sweepJoin = None
+
+    def open(self, conn=None):
+        Stage.open(self, conn)
+        self.overlapSql = 'select * from ' + self.table + ' where ' + self.chromCol + '=%s AND (' + self.startCol + ' <= %s AND %s <= ' + self.endCol + ');'
+
+    def queryOverlapping(self, chr, pos):
+        """ Runs the overlap query for pos, the rows are left in the cursor """
+        self.cursor.execute (self.overlapSql, (chr, int(pos), int(pos)))
+
+    def preload(self):
+        if self.indexable:
+            self.index = intervals.loadIndex(self.conn, self.table, chromCol=self.chromCol, startCol=self.startCol, endCol=self.endCol)
+
+    def sweep(self):
+        if self.indexable and self.index is None:
+            self.sweepJoin = intervals.SweepJoin(self.conn, self.table, chromCol=self.chromCol, startCol=self.startCol, endCol=self.endCol)
+
+    def inMemory(self):
+        return self.index is not None
+
+    def cacheWeight(self, result):
+        if self.single:
+            return 1
+        return Stage.cacheWeight(self, result)
+
+    def locus(self, fields):
+        """ Chromosome as the table names it, and position """
+        return fields.chromName, fields.posText
+
+    def lookupBatch(self, batch):
+        if self.index is None:
+            return Stage.lookupBatch(self, batch)
+        byChrom = {}
+        for i, fields in enumerate(batch):
+            chr, pos = self.locus(fields)
+            ids, positions = byChrom.setdefault(chr, ([], []))
+            ids.append(i)
+            positions.append(int(pos))
+        results = [None] * len(batch)
+        for chr, (ids, positions) in byChrom.items():
+            for i, rows in zip(ids, self.index.stabBatch(chr, positions)):
+                if self.single:
+                    rows = firstRow(rows)
+                results[i] = rows
+        return results
+
+    def overlapping(self, chr, pos):
+        """ Rows overlapping pos found without a query, or None when the stage has to query """
+        if self.index is not None:
+            return self.index.stab(chr, int(pos))
+        if self.sweepJoin is not None:
+            rows = self.sweepJoin.stab(chr, int(pos))
+            if rows is None:
+                ## input is not sorted, query from here on
+                self.sweepJoin = None
+            return rows
+        return None
+
+    def report(self, fh_log):
+        label = self.label if self.label is not None else self.table
+        fh_log.write("In "+ str(label) + ": " +str(self.var_count) +' in ' + str(self.line_count) + ' variants\n')
+
+
+# Number of variants read, looked up and written at a time
+BATCH_SIZE = 2000
+
+""" Runs one stage over a whole file, writing the result to outfile. Returns the stage, for its counters and profile """
+def runStage(stage, infile, outfile, logfile, logmode='a', batchsize=BATCH_SIZE, sep='\t'):
+    fh = open(infile)
+    fh_out = open(outfile, "w")
+    stage.open()
+    try:
+        for batch in readBatches(fh, batchsize, sep=sep, inds=stage.inds):
+            stage.annotateBatch(batchVariants(batch))
+            writeBatch(fh_out, batch)
+        fh_out.flush()
+        stage.profile.bytesRead = profiling.fileSize(infile)
+        stage.profile.bytesWritten = profiling.fileSize(outfile)
+
+        fh_log = open(logfile, logmode)
+        stage.report(fh_log)
+        stage.reportCache(fh_log)
+        stage.reportFilters(fh_log)
+        stage.reportProfile(fh_log)
+        fh_log.close()
+    finally:
+        stage.close()
+        fh.close()
+        fh_out.close()
+    return stage
 
-                var_count=var_count+1
-                if str(fields[7])=='.':
-                    fields[7]='DB'+maf_str #fields[7]+';'+str(row[6])
-                else:
-                    fields[7]=fields[7]+';DB;VC='+varclass + maf_str
 
-                fields[2]=str(';'.join(rsids))
-                l='\t'.join([str(x) for x in fields])
-                fh_out.write(l+'\n')
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields])+'\n')
+"""" format must be pileup or vcf """
+""" Types of variants in dbSNP135: DIV, SNV,    MNV,   MIXED  """
 
-            linenum = linenum +1
+# Memory-mapped dbSNP index (snpindex.py) that the dbSNP stage uses instead of querying, see useDbSnpIndex
+dbSnpIndex = None
+
+""" Resolves dbSNP from the index at path from now on, or by querying again with None.
+    An index built from another reference than the one in use is not used """
+def useDbSnpIndex(path):
+    global dbSnpIndex
+    dbSnpIndex = None
+    if path is not None:
+        import snpindex
+        index = snpindex.openIndex(path)
+        if index.source != sql_config.referenceStamp():
+            print('Not using the dbSNP index in ' + str(path) + ', it was built from ' + str(index.source))
         else:
-            fh_out.write(line+'\n')
+            dbSnpIndex = index
+    lookupcache.clearAll()
+
+
+class DbSnpStage(Stage):
+    """ Replaces ID with the dbSNP rsIDs and flags INFO with DB and GMAF.
+
+        Lookups return the (rsID, GMAF) of the matching rows. In bulk mode a
+        batch of variants is resolved with one query per chromosome and the
+        rows are matched back to the variants here; with a dbSNP index of the
+        same variant class in use the batch is resolved from the index.
+    """
+    table = 'dbSNP'
+    counted = ('var_count', 'linenum')
+    reads = ('CHROM', 'POS', 'REF')
+    writes = ('ID', 'INFO')
+
+    def __init__(self, format='vcf', varclass='SNV', bulk=True):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.bulk = bulk
+        self.var_count = 0
+        self.linenum = 1
+        self.index = None
+        self.snpSql = 'select * from dbSNP where CHR=%s AND POS=%s AND ( REF=%s OR REF =%s )  AND INFO = %s ;'
+
+    def open(self, conn=None):
+        Stage.open(self, conn)
+        self.index = None
+        if dbSnpIndex is not None and sqlKey(dbSnpIndex.varclass) == sqlKey(self.varclass):
+            self.index = dbSnpIndex
+
+    def inMemory(self):
+        return self.index is not None
+
+    def cacheName(self):
+        return self.table + ':' + self.varclass
+
+    def cacheKey(self, fields):
+        return self.variant(fields)
+
+    def variant(self, fields):
+        return fields.chromKey, fields.pos, fields.ref
+
+    def matches(self, rows):
+        return [(str(row[3]), str(row[7])) for row in rows]
+
+    def lookup(self, fields):
+        if self.index is not None:
+            return self.index.lookupBatch([self.variant(fields)])[0]
+        chr, pos, ref = self.variant(fields)
+        compRef=getComplementary(ref)
+        if self.filterNegative(self.table, [(self.varclass, chr, pos, ref), (self.varclass, chr, pos, compRef)]):
+            return []
+
+        self.cursor.execute (self.snpSql, (chr, pos, ref, compRef, self.varclass))
+        return self.matches(self.cursor.fetchall ())
+
+    def lookupBatch(self, batch):
+        if self.index is not None:
+            return self.index.lookupBatch([self.variant(fields) for fields in batch])
+        if not self.bulk or len(batch) < 2:
+            return Stage.lookupBatch(self, batch)
+
+        keys=[]
+        byChrom={}
+        for fields in batch:
+            chr, pos, ref = self.variant(fields)
+            refs=set([sqlKey(ref), sqlKey(getComplementary(ref))])
+            keys.append((chr, pos, refs))
+            if self.filterNegative(self.table, [(self.varclass, chr, pos, ref), (self.varclass, chr, pos, getComplementary(ref))]):
+                continue
+            positions, allRefs = byChrom.setdefault(chr, (set(), set()))
+            positions.add(pos)
+            allRefs.update([ref, getComplementary(ref)])
+
+        ## one query per chromosome, rows of a position kept in the order MySQL returns them
+        found={}
+        for chr, (positions, allRefs) in byChrom.items():
+            positions=sorted(positions)
+            allRefs=sorted(allRefs)
+            sql='select CHR, POS, REF, dbSNP.* from dbSNP where CHR=%s AND POS in (' + sql_config.placeholders(len(positions)) + ') AND REF in (' + sql_config.placeholders(len(allRefs)) + ')  AND INFO = %s ;'
+            self.cursor.execute (sql, [chr] + positions + allRefs + [self.varclass])
+            for row in self.cursor.fetchall ():
+                found.setdefault((chr, int(row[1])), []).append((sqlKey(row[2]), row[3:]))
+
+        results=[]
+        for chr, pos, refs in keys:
+            results.append(self.matches([row for ref, row in found.get((chr, pos), ()) if ref in refs]))
+        return results
+
+    def apply(self, fields, matches):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2]='.'
+        if len(matches) > 0:
+            rsids=[]
+            mafs=[]
+            for rsid, gmaf in matches:
+                rsids.append(rsid)
+                if gmaf !='.':
+                    mafs.append('GMAF='+gmaf)
+
+            maf_str=''
+            if len(mafs)>0:
+                maf_str=';'+';'.join([str(x) for x in mafs])
+
+            self.var_count=self.var_count+1
+            if fields.getInfo()=='.':
+                fields[7]='DB'+maf_str #fields[7]+';'+str(row[6])
+            else:
+                fields.addInfo(';DB;VC='+self.varclass + maf_str)
 
-    ratioInDbSnp = (var_count/float(linenum))*100
-    fh_log.write("## Please notice that all Isoforms were counted "+'\n')
-    fh_log.write("## Numbers may exceed number of variants in the annotated file"+'\n')
-    fh_log.write("Total: " +str(linenum) +'\n')
-    fh_log.write("In dbSNP: " +str(var_count) + " (" + str(ratioInDbSnp) + "%)" +'\n')
-    fh_log.close()
+            fields[2]=str(';'.join(rsids))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        self.linenum = self.linenum +1
+
+    def addCounters(self, counters):
+        ## linenum starts at 1 in every shard
+        self.var_count = self.var_count + counters['var_count']
+        self.linenum = self.linenum + counters['linenum'] - 1
+        self.addCacheCounters(counters)
+
+    def report(self, fh_log):
+        ratioInDbSnp = (self.var_count/float(self.linenum))*100
+        fh_log.write("## Please notice that all Isoforms were counted "+'\n')
+        fh_log.write("## Numbers may exceed number of variants in the annotated file"+'\n')
+        fh_log.write("Total: " +str(self.linenum) +'\n')
+        fh_log.write("In dbSNP: " +str(self.var_count) + " (" + str(ratioInDbSnp) + "%)" +'\n')
+
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1', varclass='SNV', sep='\t', bulk=True):
+    return runStage(DbSnpStage(format=format, varclass=varclass, bulk=bulk), vcf, vcf+tmpextout, vcf+'.count.log', logmode='w', sep=sep)
 
 
 
@@ -240,7 +855,7 @@ def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass
     inds=getFormatSpecificIndices(format=format)
 
     fh = open(vcf)
-    conn = sql_config.conn2annotator()
+    conn = sql_config.acquire()
     cursor = conn.cursor ()
     linenum = 1
 
@@ -307,7 +922,7 @@ def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass
     fh_log.write("In dbSNP: " +str(var_count) + " (" + str(ratioInDbSnp) + "%)" +'\n')
     fh_log.close()
 
-    conn.close()
+    sql_config.release(conn)
     fh.close()
     fh_out.close()
 
@@ -318,286 +933,227 @@ def getIndelsFromDbSnp(vcf, format='vcf',  tmpextin='', tmpextout='.1', varclass
 # 3. chrom_pos_unequal
 
 ## NOTE: all isoforms are collapsed in one record
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-    fh_out = open(outfile, "w")
-    inds=getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    ##CHROM POS ID  REF ALT
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if line.startswith("#")==False:
-            fields=line.split(sep)
-            chr=fields[inds[0]].strip()
-            if(chr.startswith("chr")==True):
-                chr = chr.replace('chr', '')
-            pos=fields[inds[1]].strip()
-            ref=clean_shit(fields[inds[2]]).strip()
-            alt=clean_shit(fields[inds[3]]).strip()
-
-            compRef=getComplementary(ref)
-            compAlt=getComplementary(alt)
-
-            sql1='select * from chrom_pos_equal_base where CHR="'+ str(chr) + '" AND start = ' + str(pos) + ' AND ((haplotypeReference="'+ str(ref) + '" AND haplotypeAlternate ="'+ str(alt)+'") OR (haplotypeReference="'+ str(compRef) + '" AND haplotypeAlternate ="'+ str(compAlt)+'"));'
-            sql2='select * from chrom_pos_equal_nobase where CHR="'+ str(chr) + '" AND start = ' + str(pos) + ';'
-            sql3='select * from chrom_pos_unequal where CHR="'+ str(chr) + '" AND start <= ' + str(pos) + ' AND ' + str(pos) + ' <= end ;'
-
-            keepgoing=True
-            cursor.execute (sql1)
-            rows = cursor.fetchall ()
-
+class BigRefGeneStage(Stage):
+    """ Adds the bigRefGene record of the first table in the cascade that has the variant.
+
+        The two exact-match tables are looked up in one query: their rows are
+        unioned with a literal rank, ordered by it, and only the rows of the
+        best ranked table are kept. chrom_pos_unequal, a range scan, is only
+        queried when neither has the variant. Tables that the Bloom filters
+        rule out are left out. The parts select the whole row of their table
+        after the rank, as the tables share the bigRefGene layout; the rank is
+        stripped again, so the rows have the shape of a select *.
+    """
+    reads = ('CHROM', 'POS', 'REF', 'ALT')
+    writes = ('INFO', 'positionType')
+    # (table, condition) of the exact-match tables in order of precedence
+    cascade = [('chrom_pos_equal_base', 'CHR=%s AND start = %s AND ((haplotypeReference=%s AND haplotypeAlternate =%s) OR (haplotypeReference=%s AND haplotypeAlternate =%s))'),
+               ('chrom_pos_equal_nobase', 'CHR=%s AND start = %s')]
+    unequalSql = 'select * from chrom_pos_unequal where CHR=%s AND start <= %s AND %s <= end;'
+
+    def cacheName(self):
+        return 'bigRefGene'
+
+    def cacheKey(self, fields):
+        return (fields.chrom, fields.posText, fields.ref, fields.alt)
+
+    def lookup(self, fields):
+        chr = fields.chromKey
+        pos = fields.pos
+        ref = fields.ref
+        alt = fields.alt
+
+        compRef=getComplementary(ref)
+        compAlt=getComplementary(alt)
+
+        params=[(chr, pos, ref, alt, compRef, compAlt), (chr, pos)]
+        keys=[[(chr, pos, ref, alt), (chr, pos, compRef, compAlt)], [(chr, pos)]]
+
+        parts=[]
+        args=[]
+        for rank, (table, condition) in enumerate(self.cascade):
+            if self.filterNegative(table, keys[rank]):
+                continue
+            parts.append('select ' + str(rank) + ' as cascadeRank, t.* from ' + table + ' t where ' + condition)
+            args.extend(params[rank])
+
+        if len(parts) > 0:
+            sql = ' union all '.join(parts)
+            if len(parts) > 1:
+                sql = sql + ' order by cascadeRank'
+            self.cursor.execute (sql + ';', args)
+            rows = self.cursor.fetchall ()
             if len(rows) > 0:
+                best = rows[0][0]
+                return [row[1:] for row in rows if row[0] == best]
 
-                keepgoing=False
-                m=set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7]=fields[7]+';'+';'.join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-                l='\t'.join([str(x) for x in fields])
-                fh_out.write(l+'\n')
-
-            if keepgoing==True:
-                cursor.execute (sql2)
-                rows = cursor.fetchall ()
-
-                if len(rows) > 0:
-
-                    keepgoing=False
-                    m=set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                    fields[7]=fields[7]+';'+';'.join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    l='\t'.join([str(x) for x in fields])
-                    fh_out.write(l+'\n')
-
-            if keepgoing==True:
-                cursor.execute (sql3)
-                rows = cursor.fetchall ()
-
-                if len(rows) > 0:
-                    keepgoing=False
-                    m=set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                    fields[7]=fields[7]+';'+';'.join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    l='\t'.join([str(x) for x in fields])
-                    fh_out.write(l+'\n')
+        self.cursor.execute (self.unequalSql, (chr, pos, pos))
+        return self.cursor.fetchall ()
 
-            if keepgoing==True:
-                fh_out.write(line+'\n')
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            m=set([])
+            for row in rows:
+                m.add(refSeqRecord(row))
 
-            vcf_linenum =vcf_linenum +1
+            fields.addInfo(';'+';'.join(m))
+            if fields.infoStartsWith(".;"):
+                fields[7] = fields[7].replace('.;', '', 1)
 
-        else:
-            fh_out.write(line+'\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    return runStage(BigRefGeneStage(format=format), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 
 """ Get information about location in gene structures"""
 
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, tmpextin='.2', tmpextout='.3', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count=0
-    tfbs_count=0
+class GenesStage(Stage):
+    """ Adds the location of the variant in the gene structures of the overlapping transcripts """
+    counted = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count', 'intronic_count',
+               'non_coding_intronic_count', 'exonic_count', 'non_coding_exonic_count', 'promoter_count')
+    reads = ('CHROM', 'POS', 'positionType')
+    # Counter of each positionType
+    positionCounters = {'intron': 'intronic_count', 'non_coding_intron': 'non_coding_intronic_count', 'CDS': 'cds_count',
+                        'non_coding_exon': 'non_coding_exonic_count', 'utr5': 'utr5_count', 'utr3': 'utr3_count'}
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.genesSql = 'select * from ' + self.table + ' where chrom=%s   AND (txStart - %s) <= %s AND %s <= (txEnd + %s);'
+        self.cpgIndex = None
+
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count=0
+
+    def cacheName(self):
+        return self.table + ':' + str(self.promoter_offset)
+
+    def preload(self):
+        self.cpgIndex = intervals.loadIndex(self.conn, 'cpgIslandExt')
+
+    def lookup(self, fields):
+        return self.lookupBatch([fields])[0]
+
+    def lookupBatch(self, batch):
+        """ Returns (row, region, exonic, promoter) for each transcript within promoter_offset of each variant.
+            Variants in promoter windows are checked against the CpG islands of the whole batch at once """
+        promoter_offset = int(self.promoter_offset)
+        results = []
+        inPromoter = {}
+        for i, fields in enumerate(batch):
+            chr = fields.chromName
+            pos = fields.pos
+
+            self.cursor.execute (self.genesSql, (chr, promoter_offset, pos, pos, promoter_offset))
+            located = []
+            for row in self.cursor.fetchall ():
+                region, exonic, promoter = self.locate(transcripts.transcript(self.table, row), pos)
+                if promoter:
+                    inPromoter.setdefault(chr, []).append((i, len(located), pos))
+                located.append((row, region, exonic, 0))
+            results.append(located)
+
+        if len(inPromoter) > 0:
+            if self.cpgIndex is None:
+                self.preload()
+            nameInd = self.cpgIndex.columns.index('name')
+            for chr, promoters in inPromoter.items():
+                for (i, j, pos), cpgs in zip(promoters, self.cpgIndex.stabBatch(chr, [pos for i, j, pos in promoters])):
+                    cpg = firstRow(cpgs)
+                    if cpg is not None:
+                        results[i][j] = (results[i][j][0], 'putativePromoterRegion='+ "".join(str(cpg[nameInd]).split()), 0, 1)
+        return results
+
+    def locate(self, tx, pos):
+        """ Returns (region, exonic, inPromoter) of pos in transcript tx; promoters are told apart by the CpG islands later """
+        region=""
+        exonic=0
+
+        if tx.cdsStart == tx.cdsEnd:
+            exons=["non_coding_exon="+ "ex"+str(tx.exonNumber(e)) +'/'+str(tx.exonCount) for e in tx.exonsAt(pos)]
+            if len(exons)>0:
+                region=";".join(exons)
+
+        elif u.isBetween(pos, tx.cdsStart, tx.cdsEnd):
+            exons=["exon="+ "ex"+str(tx.exonNumber(e)) +'/'+str(tx.exonCount) for e in tx.exonsAt(pos)]
+            exonic=len(exons)
+            if len(exons)>0:
+                region=";".join(exons)
 
+        else:
+            window = tx.promoterWindow(int(self.promoter_offset))
+            if window is not None and u.isBetween(pos, window[0], window[1]):
+                return region, exonic, True
 
-    inds=getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
+        return region, exonic, False
 
-    for line in fh:
-        line = line.strip()
-        if line.startswith("#")==False:
-            fields=line.split(sep)
-            chr=fields[inds[0]].strip()
-            if(chr.startswith("chr")==False):
-                chr = "chr" + chr
-            pos=fields[inds[1]].strip()
-            ref=clean_shit(fields[inds[2]]).strip()
-            alt=clean_shit(fields[inds[3]]).strip()
+    def apply(self, fields, located):
+        if len(located) > 0:
             info_field = clean_shit(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name',';','='))
-
-
-            sql='select * from ' + table + ' where chrom="'+ str(chr) + '"   AND (txStart - ' + str(promoter_offset) +') <= ' + str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + str(promoter_offset) +');'
-
-            cursor.execute (sql)
-            rows = cursor.fetchall ()
+            positionType=str(u.parse_field(info_field, 'positionType',';','='))
+            #count location, once per transcript
+            counter=self.positionCounters.get(positionType)
+            if counter is not None:
+                setattr(self, counter, getattr(self, counter)+len(located))
             info=[]
+            for row, region, exonic, promoter in located:
+                self.exonic_count=self.exonic_count+exonic
+                self.promoter_count=self.promoter_count+promoter
 
+                if region != '':
+                    info.append(collapseGeneNames(row=row, indices=indicesKnownGenes, region=region, cnt=0) )
 
-            if len(rows) > 0:
-                cnt=1
-                for row in rows:
-                    #count location
-                    positionType=str(u.parse_field(info_field, 'positionType',';','='))
-                    if positionType=='intron':
-                        intronic_count=intronic_count+1
-                    elif positionType=='non_coding_intron':
-                        non_coding_intronic_count=non_coding_intronic_count+1
-                    elif positionType=='CDS':
-                        cds_count=cds_count+1
-                    elif positionType=='non_coding_exon':
-                        non_coding_exonic_count=non_coding_exonic_count+1
-                    elif positionType=='utr5':
-                        utr5_count=utr5_count+1
-                    elif positionType=='utr3':
-                        utr3_count=utr3_count+1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region=""
-                    pos=int(pos)
-                    exons=[]
-                    exonsSt=exonStarts.split(',')
-                    exonsEn=exonEnds.split(',')
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]) ):
-                                exnum=e+1
-                                if strand == '-':
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon="+ "ex"+str(exnum) +'/'+str(exonCount))
-                        if len(exons)>0:
-                            region=";".join(exons)
-
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]) ):
-                                exnum=e+1
-                                if strand == '-':
-                                    exnum =  exonCount - e
-                                #print strand + " exon:"+ str(exnum) +'/'+str(exonCount)
-                                exons.append("exon="+ "ex"+str(exnum) +'/'+str(exonCount))
-                                exonic_count=exonic_count+1
-                        if len(exons)>0:
-                            region=";".join(exons)
-
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and strand=="+":
-                        sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute (sql)
-                        rows = cursor.fetchone ()
-                        if rows is not None:
-                            region='putativePromoterRegion='+ "".join(str(rows[3]).split())
-                            promoter_count=promoter_count+1
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and strand=="-":
-                        sql='select chrom, chromStart, chromEnd, name from cpgIslandExt where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute (sql)
-                        rows = cursor.fetchone ()
-                        if rows is not None:
-                            region='putativePromoterRegion='+ "".join(str(rows[3]).split())
-                            promoter_count=promoter_count+1
-
-
-                    else:
-                        region=''
-
-                    if region != '':
-                        info.append(collapseGeneNames(row=row, indices=indicesKnownGenes, region=region, cnt=cnt) )
-
-
-                    cnt=cnt+1
-                #str_info= ";".join(u.dedup(info))
-                str_info= ";".join(info)
-                fields[7]=fields[7]+';' +str_info
-                fh_out.write('\t'.join(fields)+'\n')
-
-            else:
-                fields[7]=fields[7]+";positionType=interGenic"
-                fh_out.write('\t'.join(fields)+'\n')
-                interGenic_count=interGenic_count+1
-
-            linenum = linenum +1
+            #str_info= ";".join(u.dedup(info))
+            str_info= ";".join(info)
+            fields.addInfo(';' +str_info)
 
         else:
-            fh_out.write(line+'\n')
-
+            fields.addInfo(";positionType=interGenic")
+            self.interGenic_count=self.interGenic_count+1
 
-    print ("Variants located: ")
-    fh_log.write("Variants located: "+'\n')
+    def report(self, fh_log):
+        print ("Variants located: ")
+        fh_log.write("Variants located: "+'\n')
 
-    print ("In interGenic " + str(interGenic_count))
-    fh_log.write("In interGenic " + str(interGenic_count) +'\n')
+        print ("In interGenic " + str(self.interGenic_count))
+        fh_log.write("In interGenic " + str(self.interGenic_count) +'\n')
 
-    print ("In CDS " + str(cds_count))
-    fh_log.write("In CDS " + str(cds_count) +'\n')
+        print ("In CDS " + str(self.cds_count))
+        fh_log.write("In CDS " + str(self.cds_count) +'\n')
 
-    print ("In \'3 UTR " + str(utr3_count))
-    fh_log.write("In \'3 UTR " + str(utr3_count) +'\n')
+        print ("In \'3 UTR " + str(self.utr3_count))
+        fh_log.write("In \'3 UTR " + str(self.utr3_count) +'\n')
 
-    print ("In \'5 UTR " + str(utr5_count))
-    fh_log.write("In \'5 UTR " + str(utr5_count) +'\n')
+        print ("In \'5 UTR " + str(self.utr5_count))
+        fh_log.write("In \'5 UTR " + str(self.utr5_count) +'\n')
 
-    print ("In Intronic "+str(intronic_count))
-    fh_log.write("In Intronic "+str(intronic_count) +'\n')
+        print ("In Intronic "+str(self.intronic_count))
+        fh_log.write("In Intronic "+str(self.intronic_count) +'\n')
 
-    print ("In Non_coding_intronic "+str(non_coding_intronic_count))
-    fh_log.write("In Non_coding_intronic "+str(non_coding_intronic_count) +'\n')
+        print ("In Non_coding_intronic "+str(self.non_coding_intronic_count))
+        fh_log.write("In Non_coding_intronic "+str(self.non_coding_intronic_count) +'\n')
 
-    print ("In Exonic "+str(exonic_count))
-    fh_log.write("In Exonic "+str(exonic_count) +'\n')
+        print ("In Exonic "+str(self.exonic_count))
+        fh_log.write("In Exonic "+str(self.exonic_count) +'\n')
 
-    print ("In Non_coding_exonic "+str(non_coding_exonic_count))
-    fh_log.write("In Non_coding_exonic "+str(non_coding_exonic_count) +'\n')
+        print ("In Non_coding_exonic "+str(self.non_coding_exonic_count))
+        fh_log.write("In Non_coding_exonic "+str(self.non_coding_exonic_count) +'\n')
 
-    print ("In Putative Promoter Region "+str(promoter_count))
-    fh_log.write("In Putative Promoter Region "+str(promoter_count) +'\n')
+        print ("In Putative Promoter Region "+str(self.promoter_count))
+        fh_log.write("In Putative Promoter Region "+str(self.promoter_count) +'\n')
 
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, tmpextin='.2', tmpextout='.3', sep='\t'):
+    return runStage(GenesStage(format=format, table=table, promoter_offset=promoter_offset), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 
@@ -627,7 +1183,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, tmpext
 
     inds=getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = sql_config.conn2annotator()
+    conn = sql_config.acquire()
     cursor = conn.cursor ()
     linenum = 1
 
@@ -792,397 +1348,197 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, tmpext
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    sql_config.release(conn)
 
 """ Overlap with tfbsConsSites"""
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsStage(OverlapStage):
+    """ tfbsConsSites is split into one table per chromosome. Preloaded, the table of a
+        chromosome is indexed the first time the chromosome comes up (intervals.loadPartition) """
+    table = 'tfbsConsSites'
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','17','18','19','20','21','22','X','Y']
+    columns = ('chrom', 'chromStart', 'chromEnd', 'name')
 
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-
-    linenum = 1
+    def __init__(self, format='vcf', table=None):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.partitioned = False
 
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line+'\n')
+    def preload(self):
+        self.partitioned = True
 
-        #header line
-        elif line.startswith('#CHROM') or line.startswith('CHROM'):
-            fh_out.write(line+'\n')
+    def inMemory(self):
+        return self.partitioned
 
+    def lookup(self, fields):
+        return self.lookupBatch([fields])[0]
 
-        else:
-            fields=line.split(sep)
-            chr=fields[inds[0]].strip()
+    def lookupBatch(self, batch):
+        results = [() for fields in batch]
+        byTable = {}
+        for i, fields in enumerate(batch):
             # That is a special case - for some reason this table has no "chr" preceeding number
-            if(chr.startswith("chr")==False):
-                chr = "chr" + chr
-            pos=fields[inds[1]].strip()
-            isOverlap = False
+            chrIndex=fields.chromName.replace('chr', '')
+            pos=fields.pos
 
-            chrIndex=chr.replace('chr', '')
-            if chrIndex in allowed_chrom:
-                isOverlap = False
+            if chrIndex not in self.allowed_chrom:
+                continue
+            if not self.partitioned:
                 #sql='select chrom, chromStart, chromEnd, name from tfbsConsSites where  chrom="'+ str(chr) + '" AND ((( ' + str(testStart)  + ' <= chromStart) and ( ' + str(testEnd)  + ' >= chromStart)) or ((  ' + str(testStart) + ' >= chromStart ) and (' + str(testStart) + '<= chromEnd)) );'
                 ## chrom is not needed, as one table contains one chromosome
-                #sql='select chrom, chromStart, chromEnd, name from tfbsConsSites' +chrIndex+ ' where  chrom="'+ str(chr) + '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                sql='select chrom, chromStart, chromEnd, name from tfbsConsSites' +chrIndex+ ' where  chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd;'
-                #print (sql)
-                cursor.execute (sql)
-                rows = cursor.fetchall ()
-                records=[]
-
-                if len(rows) > 0:
-                    records_count=1
-                    line_count=line_count+1
-
-                    for row in rows:
-                        var_count=var_count+1
-                        t=str(row[3])+'.'+str(row[0])+'.'+str(row[1])+'.'+str(row[2])
-                        t=t.strip()
-                        records.append('tfbsRegion'+'='+t)
-
-                        records_count=records_count+1
-
-
-                    if str(fields[7]).endswith(';')==True:
-                        fields[7]=fields[7]+';'.join(records)
-                    else:
-                        fields[7]=fields[7]+';'+';'.join(records)
-
-                    fh_out.write('\t'.join(fields)+'\n')
-
-
-                else: # chrom is not on the list
-                    fh_out.write(line+'\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line+'\n')
-
-
-        linenum = linenum +1
-
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-""" Overlap with GadAll table """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
-
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
+                ## the table name comes from allowed_chrom, only the position is a parameter
+                sql='select ' + ', '.join(self.columns) + ' from tfbsConsSites' +chrIndex+ ' where  chromStart <= %s AND %s <= chromEnd;'
+                self.cursor.execute (sql, (pos, pos))
+                results[i] = self.cursor.fetchall ()
             else:
+                ids, positions = byTable.setdefault('tfbsConsSites' + chrIndex, ([], []))
+                ids.append(i)
+                positions.append(pos)
+
+        for table, (ids, positions) in byTable.items():
+            index = intervals.loadPartition(self.conn, table, self.columns)
+            for i, rows in zip(ids, index.stabBatch(table, positions)):
+                results[i] = rows
+        return results
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            records=[]
+            self.line_count=self.line_count+1
+            for row in rows:
+                self.var_count=self.var_count+1
+                t=str(row[3])+'.'+str(row[0])+'.'+str(row[1])+'.'+str(row[2])
+                t=t.strip()
+                records.append('tfbsRegion'+'='+t)
+            appendInfo(fields, ';'.join(records))
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                # That is a special case - for some reason this table has no "chr" preceeding number
-                if(chr.startswith("chr")==True):
-                    chr = str(chr).replace("chr", "")
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql='select * from ' + table + ' where chromosome="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchall ()
-                records=[]
 
-                if len(rows) > 0:
-                    records_count=1
-                    line_count=line_count+1
-                    r_tmp=[]
-                    for row in rows:
-                        var_count=var_count+1
-                        if fu.isOnTheList(r_tmp, str(row[3]))==False:
-                            r_tmp.append(str(row[3]) )
-                            #records.append(str(table)+str(records_count)+':'+str(row[3]))
-                            records.append(str(table)+'='+str(row[3]))
-                            records_count=records_count+1
-                    if str(fields[7]).endswith(';')==True:
-                        fields[7]=fields[7]+';'.join(records)
-                    else:
-                        fields[7]=fields[7]+';'+';'.join(records)
-                    fh_out.write('\t'.join(fields)+'\n')
-                else:
-                    fh_out.write(line+'\n')
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', tmpextin='.2', tmpextout='.3', sep='\t'):
+    return runStage(TfbsStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
+""" Overlap with GadAll table """
+class GadAllStage(OverlapStage):
+    table = 'gadAll'
+    indexable = True
+    chromCol = 'chromosome'
+
+    def locus(self, fields):
+        # That is a special case - for some reason this table has no "chr" preceeding number
+        return fields.chromKey, fields.posText
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return rows
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchall ()
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            records=[]
+            self.line_count=self.line_count+1
+            r_tmp=[]
+            for row in rows:
+                self.var_count=self.var_count+1
+                if fu.isOnTheList(r_tmp, str(row[3]))==False:
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table)+'='+str(row[3]))
+            appendInfo(fields, ';'.join(records))
 
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
 
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(GadAllStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
+class GwasCatalogStage(OverlapStage):
+    table = 'gwasCatalog'
+
+    def open(self, conn=None):
+        OverlapStage.open(self, conn)
+        self.gwasSql = 'select * from ' + self.table + ' where chrom=%s AND chromEnd = %s;'
+
+    def lookup(self, fields):
+        chr = fields.chromName
+        pos = fields.pos
+        if self.filterNegative(self.table, [(chr, pos)]):
+            return ()
+        self.cursor.execute (self.gwasSql, (chr, pos))
+        return self.cursor.fetchall ()
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            records=[]
+            self.line_count=self.line_count+1
+            for row in rows:
+                self.var_count=self.var_count+1
+                records.append(str(self.table)+'='+str('pubMedID')+'='+str(row[5]) + ',trait='+str(row[10]))
+            appendInfo(fields, ';'.join(records))
 
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND chromEnd = ' + str(pos) + ';'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchall ()
-                records=[]
-
-                if len(rows) > 0:
-                    line_count=line_count+1
-                    records_count=1
-                    for row in rows:
-                        var_count=var_count+1
-                        records.append(str(table)+'='+str('pubMedID')+'='+str(row[5]) + ',trait='+str(row[10]))
-                        records_count=records_count+1
-                    if str(fields[7]).endswith(';')==True:
-                        fields[7]=fields[7]+';'.join(records)
-                    else:
-                        fields[7]=fields[7]+';'+';'.join(records)
-                    fh_out.write('\t'.join(fields)+'\n')
-                else:
-                    fh_out.write(line+'\n')
-
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(GwasCatalogStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 
 """ Overlap with HUGO Gene Nomenclature Committee (HGNC)  table """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
+class HugoStage(OverlapStage):
+    table = 'hugo'
+    indexable = True
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return rows
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchall ()
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            records=[]
+            self.line_count=self.line_count+1
+            r_tmp=[]
+            for row in rows:
+                self.var_count=self.var_count+1
+                t=str(str(row[5]) +','+ str(row[6])).strip()
+                if fu.isOnTheList(r_tmp,  t)==False:
+                    r_tmp.append( t )
+                    records.append('HGNC_GeneAnnotation'+'='+t)
+            appendInfo(fields, ','.join(records).replace(';',','))
 
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchall ()
-                records=[]
-
-                if len(rows) > 0:
-                    line_count=line_count+1
-                    records_count=1
-                    r_tmp=[]
-                    for row in rows:
-                        var_count=var_count+1
-                        t=str(str(row[5]) +','+ str(row[6])).strip()
-                        #print t
-                        if fu.isOnTheList(r_tmp,  t)==False:
-                            r_tmp.append( t )
-                            records.append('HGNC_GeneAnnotation'+'='+t)
-
-                        records_count=records_count+1
-                    records_str=','.join(records).replace(';',',')
-
-                    if str(fields[7]).endswith(';')==True:
-                        fields[7]=fields[7]+records_str
-                    else:
-                        fields[7]=fields[7]+';'+records_str
-                    fh_out.write('\t'.join(fields)+'\n')
-                else:
-                    fh_out.write(line+'\n')
-
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(HugoStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 
 """ Overlap with segdup regions genomicSuperDups"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-
-    inds=getFormatSpecificIndices(format=format)
-
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
+class SuperDupsStage(OverlapStage):
+    table = 'genomicSuperDups'
+    indexable = True
+    single = True
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return firstRow(rows)
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchone ()
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count=self.line_count+1
+            self.var_count=self.var_count+1
+            isOverlap=True
+            otherChrom=row[7]
+            otherStart=row[8]
+            otherEnd=row[9]
+            fields.addInfo(';'+str(self.table)+'='+str(isOverlap)+';'+'otherChrom='+str(otherChrom)+';otherStart='+str(otherStart)+';otherEnd='+str(otherEnd))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-
-                isOverlap = False
-                otherChrom=''
-                otherStart=''
-                otherEnd=''
-                l=str(isOverlap)
-
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchone ()
-                if rows is not None:
-                    line_count=line_count+1
-                    var_count=var_count+1
-                    isOverlap=True
-                    #row=rows[0]
-                    otherChrom=rows[7]
-                    otherStart=rows[8]
-                    otherEnd=rows[9]
-                    fields[7]=fields[7]+';'+str(table)+'='+str(isOverlap)+';'+'otherChrom='+str(otherChrom)+';otherStart='+str(otherStart)+';otherEnd='+str(otherEnd)
-
-                fh_out.write('\t'.join(fields)+'\n')
-                #print(line+sep+str(isOverlap)+'\n')
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(SuperDupsStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 """ Searches Genes Databases and returns Genes/Cytobands with which SNP or INDEL overlaps"""
@@ -1210,7 +1566,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene', tmpextin='', tmpex
 
 
     inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
+    conn = sql_config.acquire()
     cursor = conn.cursor ()
     linenum = 1
 
@@ -1255,7 +1611,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene', tmpextin='', tmpex
     fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
     fh_log.close()
 
-    conn.close()
+    sql_config.release(conn)
     fh.close()
     fh_out.close()
 
@@ -1263,204 +1619,100 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene', tmpextin='', tmpex
 
 
 """ Method to find overlap with Cytoband table"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    #refGene
-    colindex=12
-    startName = 'txStart'
-    endName = 'txEnd'
+class CytobandStage(OverlapStage):
+    table = 'cytoBand'
+    indexable = True
+
+    def __init__(self, format='vcf', table=None):
+        OverlapStage.__init__(self, format=format, table=table)
+        #refGene
+        self.colindex=12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if self.table == 'cytoBand':
+            self.colindex=3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+        self.startCol = self.startName
+        self.endCol = self.endName
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return rows
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchall ()
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            overlapsWith=[]
+            self.line_count=self.line_count+1
+            for row in rows:
+                self.var_count=self.var_count+1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith=u.dedup(overlapsWith)
+            cytoband=';'.join([str(x) for x in overlapsWith])
+            appendInfo(fields, str(self.table)+'='+str(cytoband))
 
-    if table == 'cytoBand':
-        colindex=3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
-
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (' + startName + ' <= ' + str(pos) + ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith=[]
-                cursor.execute (sql)
-                rows = cursor.fetchall ()
-                if len(rows) > 0:
-                    line_count=line_count+1
-                    for row in rows:
-                        var_count=var_count+1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith=u.dedup(overlapsWith)
-                    cytoband=';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7]=fields[7]+str(table)+'='+str(cytoband)
-                    else:
-                        fields[7]=fields[7]+';'+str(table)+'='+str(cytoband)
-                fh_out.write('\t'.join(fields)+'\n')
-
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(CytobandStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 """ Method to find overlap with CNV tables"""
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
+class CnvStage(OverlapStage):
+    table = 'dgv_Cnv'
+    indexable = True
+    single = True
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return firstRow(rows)
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchone ()
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count=self.line_count+1
+            self.var_count=self.var_count+1
+            isOverlap=True
+            appendInfo(fields, str(self.table)+'='+str(isOverlap))
 
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
-
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchone ()
-                #correct: 460 - uncomment, 461 comment
-                if rows is not None:
-                    line_count=line_count+1
-                    var_count=var_count+1
-                    isOverlap=True
-                    if str(fields[7]).endswith(";"):
-                        fields[7]=fields[7]+str(table)+'='+str(isOverlap)
-                    else:
-                        fields[7]=fields[7]+';'+str(table)+'='+str(isOverlap)
-                fh_out.write('\t'.join(fields)+'\n')
-
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(CnvStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 ################
 ################
 
 """ Method to find overlap with targetScanS tables"""
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', tmpextin='', tmpextout='.1', sep='\t'):
-    basefile=vcf
-    vcf=basefile+tmpextin
-    outfile=basefile+tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile=basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count=0
-    line_count=0
-
-    inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
-    cursor = conn.cursor ()
-    linenum = 1
+class MiRNAStage(OverlapStage):
+    table = 'targetScanS'
+    indexable = True
+    single = True
+    label = 'miRNAsites'
+
+    def lookup(self, fields):
+        chr, pos = self.locus(fields)
+        rows = self.overlapping(chr, pos)
+        if rows is not None:
+            return firstRow(rows)
+        self.queryOverlapping(chr, pos)
+        return self.cursor.fetchone ()
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.line_count=self.line_count+1
+            self.var_count=self.var_count+1
+            t=str(row[4])+','+  str(row[1]) + '_'+  str(row[2])+ '_'+  str(row[3])
+            appendInfo(fields, 'miRNAsites='+t.strip())
 
-    for line in fh:
-        #print ('Line ' + str(linenum))
-        line = line.strip()
-        ## not comments
-        if line.startswith("##")==False:
-            #header line
-            if line.startswith('CHROM') or line.startswith('#CHROM') :
-                fh_out.write(line+'\n')
-            else:
 
-                fields=line.split(sep)
-                chr=fields[inds[0]].strip()
-                if(chr.startswith("chr")==False):
-                    chr = "chr" + chr
-                pos=fields[inds[1]].strip()
-                sql='select * from ' + table + ' where chrom="'+ str(chr) +  '" AND (chromStart <= ' + str(pos) + ' AND ' + str(pos) + ' <= chromEnd);'
-                #print(sql)
-                cursor.execute (sql)
-                rows = cursor.fetchone ()
-                #correct: 460 - uncomment, 461 comment
-                if rows is not None:
-                    line_count=line_count+1
-                    var_count=var_count+1
-                    t=str(rows[4])+','+  str(rows[1]) + '_'+  str(rows[2])+ '_'+  str(rows[3])
-                    t='miRNAsites='+t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7]=fields[7]+t
-                    else:
-                        fields[7]=fields[7]+';'+t
-                fh_out.write('\t'.join(fields)+'\n')
-
-
-            linenum = linenum +1
-        else:
-            fh_out.write(line+'\n')
-
-    fh_log.write("In miRNAsites: " +str(var_count) +' in ' + str(line_count) + ' variants\n')
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', tmpextin='', tmpextout='.1', sep='\t'):
+    return runStage(MiRNAStage(format=format, table=table), vcf+tmpextin, vcf+tmpextout, vcf+'.count.log', sep=sep)
 
 
 ################################################################################################
@@ -1481,7 +1733,7 @@ def addOverlapWithPutativePromoter(vcf, format='vcf', table='putativePromoter',
     line_count=0
 
     inds=getFormatSpecificIndices(format=format)
-    conn = sql_config.conn2annotator()
+    conn = sql_config.acquire()
     cursor = conn.cursor ()
     linenum = 1
 
@@ -1524,6 +1776,6 @@ def addOverlapWithPutativePromoter(vcf, format='vcf', table='putativePromoter',
     fh_log.write("In "+ str(table) + ": " +str(var_count) +' in ' + str(line_count) + ' variants\n')
     fh_log.close()
 
-    conn.close()
+    sql_config.release(conn)
     fh.close()
     fh_out.close()
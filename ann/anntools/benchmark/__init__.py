@@ -0,0 +1,9 @@
+""" Offline benchmark of the annotation pipeline.
+
+    synthref builds a synthetic reference pack with every table driver.run
+    queries (or an SQL dump of it for a local MySQL), synthvcf generates VCFs
+    of any size against it, and bench runs the pipeline on them and reports
+    the variants per second of every stage and of the whole job. Run from the
+    anntools directory:
+        python -m benchmark all <work_dir> [variants] [samples] [scale]
+"""
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+""" Command line of the benchmark, run from the anntools directory:
+        python -m benchmark reference <pack_dir> [scale] [seed]
+        python -m benchmark mysql <pack_dir> <dump.sql>
+        python -m benchmark vcf <pack_dir> <out.vcf[.gz]> [variants] [dbsnp_rate] [samples] [chrom_mix] [seed]
+        python -m benchmark run <pack_dir|mysql> <vcf> [workers] [threads]
+        python -m benchmark all <work_dir> [variants] [samples] [scale]
+"""
+
+import os
+import sys
+import refpack
+from benchmark import bench, synthref, synthvcf
+
+# Variants of a benchmark VCF unless given
+DEFAULT_VARIANTS = 100000
+
+
+def usage():
+    print(__doc__)
+    sys.exit(1)
+
+
+def arg(i, default, type=str):
+    if len(sys.argv) > i and sys.argv[i] != '':
+        return type(sys.argv[i])
+    return default
+
+
+def buildReference(path, scale, seed):
+    manifest = synthref.buildReference(path, scale, seed)
+    print('Built synthetic reference ' + manifest['stamp'] + ' with ' + str(sum([t['rows'] for t in manifest['tables'].values()])) + ' rows into ' + path)
+
+
+def generateVcf(packPath, path, variants, dbsnpRate, samples, mix, seed):
+    synthvcf.generateVcf(packPath, path, variants, dbsnpRate, samples, mix, seed)
+    print('Generated ' + str(variants) + ' variants with ' + str(samples) + ' samples into ' + path)
+
+
+if __name__ == '__main__':
+    command = arg(1, None)
+    if command == 'reference' and len(sys.argv) > 2:
+        buildReference(sys.argv[2], arg(3, 1.0, float), arg(4, 1, int))
+    elif command == 'mysql' and len(sys.argv) > 3:
+        synthref.dumpMysql(sys.argv[2], sys.argv[3])
+        print('Wrote ' + sys.argv[3] + ', load it with: mysql <database> < ' + sys.argv[3])
+    elif command == 'vcf' and len(sys.argv) > 3:
+        generateVcf(sys.argv[2], sys.argv[3], arg(4, DEFAULT_VARIANTS, int), arg(5, 0.4, float), arg(6, 0, int), arg(7, None), arg(8, 1, int))
+    elif command == 'run' and len(sys.argv) > 3:
+        bench.runBenchmark(sys.argv[2], sys.argv[3], workers=arg(4, 1, int), threads=arg(5, 1, int))
+    elif command == 'all' and len(sys.argv) > 2:
+        workdir = os.path.abspath(sys.argv[2])
+        variants = arg(3, DEFAULT_VARIANTS, int)
+        samples = arg(4, 0, int)
+        packPath = os.path.join(workdir, 'reference')
+        if not os.path.exists(os.path.join(packPath, refpack.PACK_MANIFEST)):
+            buildReference(packPath, arg(5, 1.0, float), 1)
+        vcfPath = os.path.join(workdir, 'bench_' + str(variants) + '_' + str(samples) + '.vcf')
+        if not os.path.exists(vcfPath):
+            generateVcf(packPath, vcfPath, variants, 0.4, samples, None, 1)
+        bench.runBenchmark(packPath, vcfPath)
+    else:
+        usage()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+""" Runs the pipeline on a VCF and reports the variants per second of every stage and of the whole job.
+
+    The numbers come from the .metrics.json driver.run writes next to the
+    input (profiling.py). A stage's rate is over the time spent in its own
+    lookups and applies. With threads or workers the stages overlap, so the
+    end-to-end rate is not the sum of the stage rates.
+"""
+
+import json
+import driver
+import profiling
+
+
+""" Annotates vcfPath against the reference pack at reference, or the MySQL server in config.txt when
+    reference is 'mysql', and returns its metrics after printing the report """
+def runBenchmark(reference, vcfPath, workers=1, threads=1, preload=None, binary=False, compress=False):
+    pack = None if reference == 'mysql' else reference
+    driver.run(vcfPath, 'vcf', preload=preload, workers=workers, threads=threads, pack=pack, binary=binary, compress=compress)
+    fh = open(vcfPath + '.metrics.json')
+    metrics = json.load(fh)
+    fh.close()
+    print(report(metrics))
+    return metrics
+
+
+def report(metrics):
+    lines = ['%-28s %10s %10s %10s %12s %10s %10s %10s' % ('Stage', 'variants', 'wall s', 'CPU s', 'variants/s', 'queries', 'rows', 'cache hits')]
+    for stage in metrics['stages']:
+        lines.append('%-28s %10d %10.3f %10.3f %12d %10d %10d %10d' % (stage['stage'], stage['variants'], stage['wallTime'], stage['cpuTime'],
+                                                                      stage['variantsPerSecond'], stage['queries'], stage['rows'], stage['cacheHits']))
+    lines.append('%-28s %10d %10.3f %10.3f %12d' % ('End to end', metrics['variants'], metrics['wallTime'], metrics['cpuTime'],
+                                                   profiling.rate(metrics['variants'], metrics['wallTime'])))
+    return '\n'.join(lines)
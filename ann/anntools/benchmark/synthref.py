@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+""" Synthetic reference database with every table driver.run queries.
+
+    The tables have the columns the stages read, at the positions they read
+    them, and are filled around a synthetic genome with the hg19 chromosome
+    lengths: transcripts with exons and CDS over part of every chromosome, CpG
+    islands at their promoters, dbSNP sites (most of them in transcripts, with
+    their bigRefGene rows), GWAS hits at some of the sites, and the overlap
+    tables as intervals of about the density and length of the UCSC tables.
+    Row counts scale with the scale argument; scale 1 is about 1.3 million rows.
+
+    The reference is written as an annotation pack (refpack.py), so
+    driver.run(pack=...) annotates against it without a server. dumpMysql()
+    writes it out as SQL for a local MySQL.
+"""
+
+import bisect
+import os
+import random
+import sqlite3
+import refpack
+import sql_config
+
+# hg19 lengths of the chromosomes the pipeline annotates
+CHROM_LENGTHS = [('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276), ('5', 180915260),
+                 ('6', 171115067), ('7', 159138663), ('8', 146364022), ('9', 141213431), ('10', 135534747),
+                 ('11', 135006516), ('12', 133851895), ('13', 115169878), ('14', 107349540), ('15', 102531392),
+                 ('16', 90354753), ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+                 ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566)]
+
+# Rows per megabase at scale 1
+DENSITY = {'dbSNP': 160, 'refGene': 8, 'cpgIslandExt': 3, 'tfbsConsSites': 100, 'dgv_Cnv': 16,
+           'mcCarroll_Cnv': 0.5, 'conrad_Cnv': 3, 'genomicSuperDups': 16}
+# Chromosomes holding the immunoglobulin and T cell receptor loci of abParts_IG_T_CelReceptors
+RECEPTOR_CHROMS = ('2', '7', '14', '22')
+
+# Share of the dbSNP sites inside transcripts, and of those with bigRefGene rows (with bases, without)
+SITES_IN_GENES = 0.6
+SITES_BASE = 0.5
+SITES_NOBASE = 0.15
+# Share of the dbSNP sites in the 500 bases upstream of a transcript, where the promoter CpG islands are
+SITES_PROMOTER = 0.03
+# Share of the dbSNP sites that are insertions (class DIV) rather than SNVs, and that are GWAS hits
+SITES_DIV = 0.1
+SITES_GWAS = 0.02
+
+BIGREFGENE_COLUMNS = [('bin', 'i'), ('CHR', 't'), ('start', 'i'), ('end', 'i'), ('haplotypeReference', 't'), ('haplotypeAlternate', 't'),
+                      ('name', 't'), ('name2', 't'), ('transcriptStrand', 't'), ('positionType', 't'), ('frame', 'i'),
+                      ('mrnaCoord', 't'), ('codonCoord', 't'), ('spliceDist', 'i'), ('referenceCodon', 't'), ('referenceAA', 't'),
+                      ('variantCodon', 't'), ('variantAA', 't'), ('changesAA', 't'), ('functionalClass', 't'),
+                      ('codingCoordStr', 't'), ('proteinCoordStr', 't'), ('inCodingRegion', 't'), ('spliceInfo', 't'), ('uorfChange', 't')]
+INTERVAL_COLUMNS = [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't')]
+
+# Columns of every table, with their types: i(nteger), t(ext), b(lob) or r(eal)
+TABLE_COLUMNS = {
+    'dbSNP': [('bin', 'i'), ('CHR', 't'), ('POS', 'i'), ('ID', 't'), ('REF', 't'), ('ALT', 't'), ('INFO', 't'), ('GMAF', 't')],
+    'chrom_pos_equal_base': BIGREFGENE_COLUMNS,
+    'chrom_pos_equal_nobase': BIGREFGENE_COLUMNS,
+    'chrom_pos_unequal': BIGREFGENE_COLUMNS,
+    'refGene': [('bin', 'i'), ('name', 't'), ('chrom', 't'), ('strand', 't'), ('txStart', 'i'), ('txEnd', 'i'), ('cdsStart', 'i'), ('cdsEnd', 'i'),
+                ('exonCount', 'i'), ('exonStarts', 'b'), ('exonEnds', 'b'), ('score', 'i'), ('name2', 't'), ('cdsStartStat', 't'),
+                ('cdsEndStat', 't'), ('exonFrames', 'b')],
+    'cpgIslandExt': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('length', 'i'),
+                     ('cpgNum', 'i'), ('gcNum', 'i'), ('perCpg', 'r'), ('perGc', 'r'), ('obsExp', 'r')],
+    'cytoBand': [('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('gieStain', 't')],
+    'gadAll': [('id', 'i'), ('associationStatus', 't'), ('broadPhen', 't'), ('diseaseClass', 't'), ('geneSymbol', 't'),
+               ('chromosome', 't'), ('chromStart', 'i'), ('chromEnd', 'i')],
+    'gwasCatalog': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('pubMedID', 't'),
+                    ('author', 't'), ('pubDate', 't'), ('journal', 't'), ('title', 't'), ('trait', 't')],
+    'hugo': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('hgncId', 't'), ('symbol', 't'), ('name', 't')],
+    'dgv_Cnv': INTERVAL_COLUMNS,
+    'abParts_IG_T_CelReceptors': INTERVAL_COLUMNS,
+    'mcCarroll_Cnv': INTERVAL_COLUMNS,
+    'conrad_Cnv': INTERVAL_COLUMNS,
+    'genomicSuperDups': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('score', 'i'),
+                         ('strand', 't'), ('otherChrom', 't'), ('otherStart', 'i'), ('otherEnd', 'i'), ('otherSize', 'i')],
+    'targetScanS': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('score', 'i'), ('strand', 't')],
+    'tfbsConsSites': [('bin', 'i'), ('chrom', 't'), ('chromStart', 'i'), ('chromEnd', 'i'), ('name', 't'), ('score', 'i'),
+                      ('strand', 't'), ('zScore', 'r')],
+}
+
+BASES = 'ACGT'
+
+
+def tableColumns(table):
+    """ Columns of table; the per-chromosome tfbsConsSites tables share theirs """
+    if table.startswith('tfbsConsSites'):
+        return TABLE_COLUMNS['tfbsConsSites']
+    return TABLE_COLUMNS[table]
+
+
+class ReferenceWriter(object):
+    """ Buffers the rows of every table of the pack database and inserts them in chunks, in the order they were added """
+
+    def __init__(self, db):
+        self.db = db
+        self.inserts = {}
+        self.pending = {}
+        self.rows = {}
+
+    def create(self, table):
+        names = [name for name, type in tableColumns(table)]
+        self.inserts[table] = refpack.createTable(self.db, table, names)
+        self.pending[table] = []
+        self.rows[table] = 0
+
+    def add(self, table, row):
+        pending = self.pending[table]
+        pending.append(row)
+        if len(pending) >= refpack.EXPORT_CHUNK:
+            self.flush(table)
+
+    def flush(self, table):
+        self.db.executemany(self.inserts[table], self.pending[table])
+        self.rows[table] = self.rows[table] + len(self.pending[table])
+        self.pending[table] = []
+
+
+class Gene(object):
+    """ One synthetic transcript, with what the bigRefGene rows of the sites in it need """
+
+    def __init__(self, rng, chrom, number, chromLength):
+        length = min(max(int(rng.lognormvariate(9.5, 1.0)), 500), 2000000)
+        self.txStart = rng.randint(10000, max(10001, chromLength - length - 10000))
+        self.txEnd = self.txStart + length
+        exonCount = rng.randint(1, min(40, max(1, length // 500)))
+        cuts = sorted(rng.sample(range(self.txStart + 1, self.txEnd), 2 * (exonCount - 1)))
+        self.exonStarts = [self.txStart] + cuts[1::2]
+        self.exonEnds = cuts[0::2] + [self.txEnd]
+        self.strand = rng.choice('+-')
+        if rng.random() < 0.85:
+            cds = sorted([rng.randint(self.txStart, self.exonEnds[0]), rng.randint(self.exonStarts[-1], self.txEnd)])
+            self.cdsStart, self.cdsEnd = cds
+        else:
+            self.cdsStart = self.txEnd
+            self.cdsEnd = self.txEnd
+        self.name = ('NM_' if self.cdsStart < self.cdsEnd else 'NR_') + str(100000 + number)
+        self.name2 = 'G' + chrom + '_' + str(number)
+
+    def positionType(self, pos):
+        """ Where pos falls in the transcript, as bigRefGene names it """
+        e = bisect.bisect_right(self.exonStarts, pos) - 1
+        exonic = e >= 0 and pos <= self.exonEnds[e]
+        if self.cdsStart == self.cdsEnd:
+            return 'non_coding_exon' if exonic else 'non_coding_intron'
+        if not exonic:
+            return 'intron'
+        if self.cdsStart <= pos <= self.cdsEnd:
+            return 'CDS'
+        if (pos < self.cdsStart) == (self.strand == '+'):
+            return 'utr5'
+        return 'utr3'
+
+    def refGeneRow(self, chrom, isoform):
+        exonStarts = (','.join([str(x) for x in self.exonStarts]) + ',').encode('utf-8')
+        exonEnds = (','.join([str(x) for x in self.exonEnds]) + ',').encode('utf-8')
+        frames = (','.join(['0'] * len(self.exonStarts)) + ',').encode('utf-8')
+        return (0, self.name + ('.' + str(isoform) if isoform > 0 else ''), 'chr' + chrom, self.strand, self.txStart, self.txEnd,
+                self.cdsStart, self.cdsEnd, len(self.exonStarts), exonStarts, exonEnds, 0, self.name2, 'cmpl', 'cmpl', frames)
+
+    def bigRefGeneRow(self, rng, chrom, start, end, ref, alt, positionType):
+        coding = positionType == 'CDS'
+        codon = ''.join([rng.choice(BASES) for i in range(0, 3)])
+        variantCodon = codon[:2] + (alt[:1] if alt != '' else codon[2])
+        return (0, chrom, start, end, ref, alt, self.name, self.name2, self.strand, positionType,
+                rng.randint(0, 2) if coding else -1, 'c.' + str(start - self.txStart), str(rng.randint(1, 3)) if coding else '',
+                rng.randint(-20, 20), codon if coding else '', 'K' if coding else '', variantCodon if coding else '',
+                rng.choice('KNR') if coding else '', rng.choice(['', 'K>N', 'K>R']) if coding else '',
+                rng.choice(['silent', 'missense', 'nonsense']) if coding else positionType,
+                'c.' + str(start - self.cdsStart) + ref + '>' + alt if coding else '', 'p.K' + str(rng.randint(1, 2000)) if coding else '',
+                'true' if coding else 'false', '', '')
+
+
+def count(rng, table, chromLength, scale):
+    """ Rows of table for a chromosome, at the density of the table """
+    expected = DENSITY[table] * chromLength / 1000000.0 * scale
+    n = int(expected)
+    if rng.random() < expected - n:
+        n = n + 1
+    return n
+
+
+def intervalLength(rng, median, most):
+    return min(max(int(rng.lognormvariate(0, 1.0) * median), 1), most)
+
+
+def addGenes(writer, rng, chrom, chromLength, scale):
+    genes = []
+    for g in range(0, count(rng, 'refGene', chromLength, scale)):
+        gene = Gene(rng, chrom, len(genes), chromLength)
+        genes.append(gene)
+        for isoform in range(0, rng.choice([1, 1, 2])):
+            writer.add('refGene', gene.refGeneRow(chrom, isoform))
+
+        if rng.random() < 0.5:
+            ## island over the promoter
+            tss = gene.txStart if gene.strand == '+' else gene.txEnd
+            start = tss - rng.randint(0, 1000)
+            addCpgIsland(writer, rng, chrom, start, start + rng.randint(200, 2000))
+        writer.add('hugo', (0, 'chr' + chrom, gene.txStart, gene.txEnd, 'HGNC:' + str(rng.randint(1, 50000)), gene.name2,
+                            'synthetic gene ' + gene.name2 + '; ' + rng.choice(['kinase', 'receptor', 'transporter', 'zinc finger'])))
+        if rng.random() < 0.3:
+            writer.add('gadAll', (rng.randint(1, 100000), rng.choice(['Y', 'N', '']), 'Disease ' + str(rng.randint(1, 500)),
+                                  rng.choice(['CANCER', 'METABOLIC', 'NEUROLOGICAL', 'IMMUNE']), gene.name2, chrom, gene.txStart, gene.txEnd))
+        if gene.cdsStart < gene.cdsEnd:
+            ## miRNA sites in the 3' UTR end of the transcript
+            for i in range(0, rng.randint(0, 3)):
+                start = rng.randint(gene.exonStarts[-1], gene.txEnd) if gene.strand == '+' else rng.randint(gene.txStart, gene.exonEnds[0])
+                writer.add('targetScanS', (0, 'chr' + chrom, start, start + 7, gene.name2 + ':miR-' + str(rng.randint(1, 900)), rng.randint(50, 100), gene.strand))
+        for e in range(0, min(len(gene.exonStarts) - 1, 3)):
+            writer.add('chrom_pos_unequal', gene.bigRefGeneRow(rng, chrom, gene.exonEnds[e] + 1, gene.exonStarts[e + 1] - 1, '', '', gene.positionType(gene.exonEnds[e] + 1)))
+
+    for i in range(0, count(rng, 'cpgIslandExt', chromLength, scale)):
+        start = rng.randint(1, chromLength)
+        addCpgIsland(writer, rng, chrom, start, start + rng.randint(200, 2000))
+    return genes
+
+
+def addCpgIsland(writer, rng, chrom, start, end):
+    cpgNum = rng.randint(10, 200)
+    gcNum = rng.randint(cpgNum * 2, max(cpgNum * 2, end - start))
+    writer.add('cpgIslandExt', (0, 'chr' + chrom, start, end, 'CpG: ' + str(cpgNum), end - start, cpgNum, gcNum,
+                                round(200.0 * cpgNum / (end - start), 1), round(100.0 * gcNum / (end - start), 1), round(rng.uniform(0.6, 1.2), 2)))
+
+
+def addSites(writer, rng, chrom, chromLength, scale, genes, firstId):
+    """ dbSNP sites, with their bigRefGene and gwasCatalog rows, numbered from firstId; returns the next id """
+    rsid = firstId
+    sites = []
+    for i in range(0, count(rng, 'dbSNP', chromLength, scale)):
+        gene = None
+        draw = rng.random()
+        if len(genes) > 0 and draw < SITES_IN_GENES:
+            gene = rng.choice(genes)
+            pos = rng.randint(gene.txStart, gene.txEnd)
+        elif len(genes) > 0 and draw < SITES_IN_GENES + SITES_PROMOTER:
+            upstream = rng.choice(genes)
+            pos = upstream.txStart - rng.randint(1, 500) if upstream.strand == '+' else upstream.txEnd + rng.randint(1, 500)
+        else:
+            pos = rng.randint(1, chromLength)
+        sites.append((pos, gene))
+    sites.sort(key=lambda site: site[0])
+
+    for pos, gene in sites:
+        ref = rng.choice(BASES)
+        if rng.random() < SITES_DIV:
+            varclass = 'DIV'
+            alt = ref + rng.choice(BASES)
+        else:
+            varclass = 'SNV'
+            alt = rng.choice([b for b in BASES if b != ref])
+        name = 'rs' + str(rsid)
+        rsid = rsid + 1
+        gmaf = '.' if rng.random() < 0.5 else str(round(rng.uniform(0.001, 0.5), 3))
+        writer.add('dbSNP', (0, chrom, pos, name, ref, alt, varclass, gmaf))
+
+        if gene is not None:
+            draw = rng.random()
+            if draw < SITES_BASE:
+                writer.add('chrom_pos_equal_base', gene.bigRefGeneRow(rng, chrom, pos, pos, ref, alt, gene.positionType(pos)))
+            elif draw < SITES_BASE + SITES_NOBASE:
+                writer.add('chrom_pos_equal_nobase', gene.bigRefGeneRow(rng, chrom, pos, pos, '', '', gene.positionType(pos)))
+        if rng.random() < SITES_GWAS:
+            writer.add('gwasCatalog', (0, 'chr' + chrom, pos - 1, pos, name, str(rng.randint(10000000, 29999999)), 'Author ' + str(rng.randint(1, 999)),
+                                       str(rng.randint(2005, 2020)), rng.choice(['Nat Genet', 'Am J Hum Genet', 'PLoS Genet']),
+                                       'Genome-wide association study ' + str(rng.randint(1, 9999)), 'Trait ' + str(rng.randint(1, 300))))
+    return rsid
+
+
+def addTfbs(writer, rng, chrom, chromLength, scale, genes):
+    table = 'tfbsConsSites' + chrom
+    rows = []
+    for i in range(0, count(rng, 'tfbsConsSites', chromLength, scale)):
+        if len(genes) > 0 and rng.random() < 0.7:
+            ## upstream of a transcript
+            gene = rng.choice(genes)
+            tss = gene.txStart if gene.strand == '+' else gene.txEnd
+            start = max(1, tss + (rng.randint(-5000, 0) if gene.strand == '+' else rng.randint(0, 5000)))
+        else:
+            start = rng.randint(1, chromLength)
+        rows.append((0, 'chr' + chrom, start, start + rng.randint(10, 25), 'V$TF' + str(rng.randint(1, 400)), rng.randint(700, 1000),
+                     rng.choice('+-'), round(rng.uniform(1.6, 5.0), 2)))
+    rows.sort(key=lambda row: row[2])
+    for row in rows:
+        writer.add(table, row)
+
+
+def addIntervals(writer, rng, chrom, chromLength, scale):
+    ## cytoBand tiles the chromosome
+    start = 0
+    band = 1
+    centromere = int(chromLength * 0.4)
+    while start < chromLength:
+        end = min(chromLength, start + rng.randint(1000000, 6000000))
+        arm = 'p' if start < centromere else 'q'
+        writer.add('cytoBand', ('chr' + chrom, start, end, arm + str(band // 10 + 1) + '.' + str(band % 10 + 1),
+                                rng.choice(['gneg', 'gpos25', 'gpos50', 'gpos75', 'gpos100'])))
+        start = end
+        band = band + 1
+
+    for table, median, most in (('dgv_Cnv', 10000, 2000000), ('mcCarroll_Cnv', 20000, 500000), ('conrad_Cnv', 5000, 200000)):
+        for i in range(0, count(rng, table, chromLength, scale)):
+            start = rng.randint(1, chromLength)
+            writer.add(table, (0, 'chr' + chrom, start, start + intervalLength(rng, median, most), table + '_' + str(rng.randint(1, 999999))))
+    if chrom in RECEPTOR_CHROMS:
+        start = rng.randint(1, chromLength - 2000000)
+        writer.add('abParts_IG_T_CelReceptors', (0, 'chr' + chrom, start, start + rng.randint(500000, 1500000), 'IG_T_' + chrom))
+
+    for i in range(0, count(rng, 'genomicSuperDups', chromLength, scale)):
+        start = rng.randint(1, chromLength)
+        end = start + intervalLength(rng, 5000, 300000)
+        otherChrom, otherLength = rng.choice(CHROM_LENGTHS)
+        otherStart = rng.randint(1, otherLength)
+        writer.add('genomicSuperDups', (0, 'chr' + chrom, start, end, 'chr' + otherChrom + ':' + str(otherStart), rng.randint(0, 1000),
+                                        rng.choice('+-'), 'chr' + otherChrom, otherStart, otherStart + end - start, otherLength))
+
+
+""" Builds a synthetic reference pack at path; scale multiplies the row counts """
+def buildReference(path, scale=1.0, seed=1, bloomFpr=None):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    tmp = os.path.join(path, refpack.PACK_DB + '.tmp')
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    rng = random.Random(seed)
+    db = sqlite3.connect(tmp)
+    try:
+        db.execute('PRAGMA journal_mode=OFF;')
+        db.execute('PRAGMA synchronous=OFF;')
+        writer = ReferenceWriter(db)
+        for table, indexCols in refpack.packTables():
+            writer.create(table)
+
+        rsid = 1
+        for chrom, chromLength in CHROM_LENGTHS:
+            print('Generating chromosome ' + chrom)
+            genes = addGenes(writer, rng, chrom, chromLength, scale)
+            rsid = addSites(writer, rng, chrom, chromLength, scale, genes, rsid)
+            addTfbs(writer, rng, chrom, chromLength, scale, genes)
+            addIntervals(writer, rng, chrom, chromLength, scale)
+
+        tables = {}
+        for table, indexCols in refpack.packTables():
+            writer.flush(table)
+            db.commit()
+            refpack.indexTable(db, table, indexCols)
+            tables[table] = {'rows': writer.rows[table], 'columns': [name for name, type in tableColumns(table)]}
+        db.execute('ANALYZE;')
+        db.commit()
+    finally:
+        db.close()
+
+    os.rename(tmp, os.path.join(path, refpack.PACK_DB))
+    stamp = 'synthetic-' + str(seed) + '-' + str(scale)
+    return refpack.finishPack(path, stamp, {'synthetic': {'scale': scale, 'seed': seed}}, tables, bloomFpr)
+
+
+# MySQL types of the column types
+MYSQL_TYPES = {'i': 'BIGINT', 't': 'VARCHAR(255)', 'b': 'LONGBLOB', 'r': 'DOUBLE'}
+# Rows per INSERT statement of the dump
+DUMP_ROWS = 1000
+
+
+def sqlLiteral(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bytes):
+        return "X'" + value.hex() + "'" if len(value) > 0 else "''"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+""" Writes the tables of the pack at path as SQL statements that load into a local MySQL database:
+        mysql <database> < sqlPath """
+def dumpMysql(path, sqlPath):
+    db = sqlite3.connect(os.path.join(path, refpack.PACK_DB))
+    fh = open(sqlPath, 'w')
+    try:
+        for table, indexCols in refpack.packTables():
+            columns = tableColumns(table)
+            fh.write('DROP TABLE IF EXISTS `' + table + '`;\n')
+            fh.write('CREATE TABLE `' + table + '` (' + ', '.join(['`' + name + '` ' + MYSQL_TYPES[type] for name, type in columns]) + ');\n')
+            cursor = db.execute('select * from ' + table + ' order by rowid;')
+            while True:
+                rows = cursor.fetchmany(DUMP_ROWS)
+                if len(rows) == 0:
+                    break
+                fh.write('INSERT INTO `' + table + '` VALUES ' + ','.join(['(' + ','.join([sqlLiteral(v) for v in row]) + ')' for row in rows]) + ';\n')
+            fh.write('CREATE INDEX `' + table + '_lookup` ON `' + table + '` (' + ', '.join(['`' + c + '`' for c in indexCols]) + ');\n')
+        ## the version the stamps of caches and indexes built against the database come from
+        fh.write('DROP TABLE IF EXISTS `' + sql_config.REFERENCE_VERSION_TABLE + '`;\n')
+        fh.write('CREATE TABLE `' + sql_config.REFERENCE_VERSION_TABLE + '` (`version` VARCHAR(255));\n')
+        fh.write('INSERT INTO `' + sql_config.REFERENCE_VERSION_TABLE + '` VALUES (' + sqlLiteral(refpack.openPack(path).stamp) + ');\n')
+    finally:
+        fh.close()
+        db.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+""" Synthetic VCFs for benchmarking, sorted and annotatable against a synthetic reference.
+
+    The variants are spread over the chromosomes of a mix, in proportion to
+    the weights of the mix. A share of them (the dbSNP hit rate) are SNV sites
+    drawn from the dbSNP table of the reference pack, so the dbSNP stage
+    matches them and the bigRefGene rows of those sites are found as well. The
+    rest are new positions drawn uniformly over the chromosome. With samples,
+    every line gets a GT:DP FORMAT column and a genotype per sample, drawn from
+    a pool so that generating millions of cohort lines stays cheap.
+"""
+
+import os
+import random
+import sqlite3
+import refpack
+import vcfio
+from benchmark import synthref
+
+# Distinct sample columns generated per input, which the lines draw from
+GENOTYPE_POOL = 256
+GENOTYPES = ['0/0', '0/0', '0/0', '0/1', '0/1', '1/1', './.']
+
+
+""" Parses a chromosome mix, '1:0.5,2:0.3,X:0.2' or '1,2,X' (equal weights), into (chrom, weight) pairs;
+    None weights every chromosome of the reference by its length """
+def parseMix(mix):
+    if mix is None or mix == '':
+        return [(chrom, float(length)) for chrom, length in synthref.CHROM_LENGTHS]
+    lengths = dict(synthref.CHROM_LENGTHS)
+    pairs = []
+    for item in mix.split(','):
+        chrom, sep, weight = item.strip().partition(':')
+        if chrom.replace('chr', '') not in lengths:
+            raise ValueError('No chromosome ' + chrom + ' in the synthetic reference')
+        pairs.append((chrom, float(weight) if weight != '' else 1.0))
+    return pairs
+
+
+""" Variant counts per chromosome of the mix, summing to variants """
+def splitCounts(variants, mix):
+    total = sum([weight for chrom, weight in mix])
+    counts = [int(variants * weight / total) for chrom, weight in mix]
+    for i in range(0, variants - sum(counts)):
+        counts[i % len(counts)] = counts[i % len(counts)] + 1
+    return counts
+
+
+def knownSites(db, chrom):
+    """ SNV sites of chrom in the dbSNP table, which the dbSNP stage matches """
+    cursor = db.execute("select POS, REF, ALT from dbSNP where CHR = ? and INFO = 'SNV';", (chrom,))
+    return cursor.fetchall()
+
+
+def genotypePool(rng, samples):
+    pool = []
+    for i in range(0, GENOTYPE_POOL):
+        pool.append('GT:DP\t' + '\t'.join([rng.choice(GENOTYPES) + ':' + str(rng.randint(5, 60)) for s in range(0, samples)]))
+    return pool
+
+
+""" Writes a sorted VCF of variants lines to path (BGZF if it ends in .gz), with a share dbsnpRate of
+    known dbSNP sites of the reference pack at packPath and samples genotype columns """
+def generateVcf(packPath, path, variants, dbsnpRate=0.4, samples=0, mix=None, seed=1):
+    rng = random.Random(seed)
+    mix = parseMix(mix)
+    lengths = dict(synthref.CHROM_LENGTHS)
+    pool = genotypePool(rng, samples) if samples > 0 else None
+
+    db = sqlite3.connect(os.path.join(packPath, refpack.PACK_DB))
+    fh_out = vcfio.openOutput(path)
+    try:
+        fh_out.write('##fileformat=VCFv4.1\n')
+        fh_out.write('##source=anntools-benchmark seed=' + str(seed) + ' dbsnpRate=' + str(dbsnpRate) + '\n')
+        fh_out.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n')
+        if samples > 0:
+            fh_out.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            fh_out.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+        header = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO'
+        if samples > 0:
+            header = header + '\tFORMAT\t' + '\t'.join(['S' + str(s + 1) for s in range(0, samples)])
+        fh_out.write(header + '\n')
+
+        for (chrom, weight), n in zip(mix, splitCounts(variants, mix)):
+            name = chrom.replace('chr', '')
+            sites = knownSites(db, name)
+            known = min(int(round(n * dbsnpRate)), n)
+            if known > len(sites):
+                picked = [rng.choice(sites) for i in range(0, known)] if len(sites) > 0 else []
+            else:
+                picked = rng.sample(sites, known)
+            lines = [(pos, ref, alt) for pos, ref, alt in picked]
+            for i in range(0, n - len(lines)):
+                ref = rng.choice(synthref.BASES)
+                lines.append((rng.randint(1, lengths[name]), ref, rng.choice([b for b in synthref.BASES if b != ref])))
+            lines.sort(key=lambda line: line[0])
+
+            for pos, ref, alt in lines:
+                line = chrom + '\t' + str(pos) + '\t.\t' + ref + '\t' + alt + '\t' + str(rng.randint(20, 99)) + '\tPASS\tDP=' + str(rng.randint(10, 500))
+                if pool is not None:
+                    line = line + '\t' + pool[rng.randrange(GENOTYPE_POOL)]
+                fh_out.write(line + '\n')
+    finally:
+        fh_out.close()
+        db.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+""" Bloom filters over the exact-match reference tables, answering definite misses without a query.
+
+    Most variants are in none of dbSNP, chrom_pos_equal_base, chrom_pos_equal_nobase
+    or gwasCatalog, yet every lookup costs a round trip to learn that. A filter
+    holds the columns a stage matches on for every row of its table, compared the
+    way MySQL compares them (sqlKey). When the filter rules out every key of a
+    lookup, the stage skips the query; when it does not, the stage queries as
+    before, so a false positive only costs the query it would have run anyway.
+
+    Filters are stored next to the reference tables they were built from, with
+    the reference stamp (sql_config.referenceStamp) in their meta.json, and
+    are only used against that same reference. refpack.py builds them into
+    the bloom directory of every pack it exports; build them for a MySQL
+    database (or a pack) with
+        python bloomfilter.py <filter_dir> [pack_dir] [false_positive_rate]
+"""
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import sys
+import annotate as ann
+import sql_config
+
+FILTER_FORMAT = 1
+FILTER_META = 'meta.json'
+
+# False positive rate the filters are sized for; lower costs more bits per row
+BLOOM_FPR = 0.01
+
+""" Tables filtered, with the columns their lookups match on """
+FILTER_TABLES = [
+    ('dbSNP', ('INFO', 'CHR', 'POS', 'REF')),
+    ('chrom_pos_equal_base', ('CHR', 'start', 'haplotypeReference', 'haplotypeAlternate')),
+    ('chrom_pos_equal_nobase', ('CHR', 'start')),
+    ('gwasCatalog', ('chrom', 'chromEnd')),
+]
+
+
+""" Key of a row or a lookup: the values compared as MySQL compares them """
+def filterKey(values):
+    return '\t'.join([ann.sqlKey(v) for v in values])
+
+
+""" Bits and hash functions of a filter holding n keys at false positive rate fpr """
+def filterSize(n, fpr):
+    n = max(n, 1)
+    bits = int(math.ceil(-n * math.log(fpr) / (math.log(2) ** 2)))
+    hashes = max(1, int(round(float(bits) / n * math.log(2))))
+    return bits, hashes
+
+
+def bitPositions(key, bits, hashes):
+    ## double hashing: the k positions are h1 + i*h2 for two halves of one digest
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i*h2) % bits for i in range(0, hashes)]
+
+
+class BloomFilter(object):
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            data = bytearray((bits + 7) // 8)
+        self.data = data
+
+    def add(self, key):
+        data = self.data
+        for bit in bitPositions(key, self.bits, self.hashes):
+            data[bit >> 3] = data[bit >> 3] | (1 << (bit & 7))
+
+    def mightContain(self, key):
+        data = self.data
+        for bit in bitPositions(key, self.bits, self.hashes):
+            if not data[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+
+def buildFilter(conn, table, columns, fpr):
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from ' + table + ';')
+    rows = int(cursor.fetchall()[0][0])
+    cursor.close()
+
+    bits, hashes = filterSize(rows, fpr)
+    filter = BloomFilter(bits, hashes)
+    cursor = sql_config.streamCursor(conn)
+    cursor.execute('select ' + ', '.join(columns) + ' from ' + table + ';')
+    for row in cursor:
+        filter.add(filterKey(row))
+    cursor.close()
+    return filter, rows
+
+
+""" Builds the filters of the configured database (or pack) into path. conn and source
+    default to a pooled connection and the reference stamp of what it reads """
+def buildFilters(path, fpr=BLOOM_FPR, conn=None, source=None):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if source is None:
+        source = sql_config.referenceStamp()
+    ownsConn = conn is None
+    if ownsConn:
+        conn = sql_config.acquire()
+
+    filters = {}
+    try:
+        for table, columns in FILTER_TABLES:
+            filter, rows = buildFilter(conn, table, columns, fpr)
+            fh = open(os.path.join(path, table + '.bloom'), 'wb')
+            fh.write(filter.data)
+            fh.close()
+            filters[table] = {'columns': list(columns), 'rows': rows, 'bits': filter.bits, 'hashes': filter.hashes}
+    finally:
+        if ownsConn:
+            sql_config.release(conn)
+
+    meta = {
+        'format': FILTER_FORMAT,
+        'fpr': fpr,
+        'source': source,
+        'filters': filters,
+    }
+    fh = open(os.path.join(path, FILTER_META), 'w')
+    json.dump(meta, fh, indent=2, sort_keys=True)
+    fh.close()
+    return meta
+
+
+class FilterSet(object):
+    """ Filters built by buildFilters, memory-mapped read-only """
+
+    def __init__(self, path):
+        fh = open(os.path.join(path, FILTER_META))
+        meta = json.load(fh)
+        fh.close()
+        if meta.get('format') != FILTER_FORMAT:
+            raise ValueError('Unsupported Bloom filter format ' + str(meta.get('format')) + ' in ' + path)
+        self.path = path
+        self.fpr = meta['fpr']
+        self.source = meta['source']
+        self.filters = {}
+        for table, info in meta['filters'].items():
+            fh = open(os.path.join(path, table + '.bloom'), 'rb')
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            fh.close()
+            self.filters[table] = BloomFilter(info['bits'], info['hashes'], data)
+
+    def get(self, table):
+        """ Filter of table, or None """
+        return self.filters.get(table)
+
+
+def openFilters(path):
+    return FilterSet(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python bloomfilter.py <filter_dir> [pack_dir] [false_positive_rate]')
+        sys.exit(1)
+    if len(sys.argv) > 2 and sys.argv[2] != '':
+        sql_config.usePack(sys.argv[2])
+    fpr = float(sys.argv[3]) if len(sys.argv) > 3 else BLOOM_FPR
+    meta = buildFilters(sys.argv[1], fpr)
+    print('Built Bloom filters of ' + ', '.join(sorted(meta['filters'])) + ' into ' + sys.argv[1])
@@ -24,6 +24,24 @@ class Config(object):
   SSL_CERT_PATH = os.environ['SSL_CERT_PATH'] if ('SSL_CERT_PATH' in os.environ) else "../ssl/server_dev.crt"
   SSL_KEY_PATH = os.environ['SSL_KEY_PATH'] if ('SSL_KEY_PATH' in os.environ) else "../ssl/server_dev.key"
 
+  # Worker processes the annotator splits a job across
+  ANNTOOLS_WORKERS = int(os.environ['ANNTOOLS_WORKERS']) if ('ANNTOOLS_WORKERS' in os.environ) else (os.cpu_count() or 1)
+  # Threads each worker looks up independent annotation stages with; every thread holds its own
+  # database connection, so the default of 1 keeps a job at one connection per worker
+  ANNTOOLS_STAGE_THREADS = int(os.environ['ANNTOOLS_STAGE_THREADS']) if ('ANNTOOLS_STAGE_THREADS' in os.environ) else 1
+  # Annotation pack directory (refpack.py) to annotate from instead of the MySQL server
+  ANNTOOLS_PACK = os.environ['ANNTOOLS_PACK'] if ('ANNTOOLS_PACK' in os.environ) else None
+  # dbSNP index directory (snpindex.py) to resolve dbSNP from instead of querying
+  ANNTOOLS_SNP_INDEX = os.environ['ANNTOOLS_SNP_INDEX'] if ('ANNTOOLS_SNP_INDEX' in os.environ) else None
+  # Variant cache file shared by the jobs of a node (see variantcache.py), None to annotate every variant
+  ANNTOOLS_VARIANT_CACHE = os.environ['ANNTOOLS_VARIANT_CACHE'] if ('ANNTOOLS_VARIANT_CACHE' in os.environ) else None
+  # Bloom filter directory (bloomfilter.py) for a MySQL reference; a pack brings its own
+  ANNTOOLS_BLOOM_FILTERS = os.environ['ANNTOOLS_BLOOM_FILTERS'] if ('ANNTOOLS_BLOOM_FILTERS' in os.environ) else None
+  # Write the annotated VCF BGZF compressed, as .annot.vcf.gz
+  ANNTOOLS_BGZF_OUTPUT = (os.environ['ANNTOOLS_BGZF_OUTPUT'].lower() in ('1', 'true', 'yes')) if ('ANNTOOLS_BGZF_OUTPUT' in os.environ) else False
+  # Read, split and write the VCF as bytes, decoding only the columns the lookups use
+  ANNTOOLS_BYTES_IO = (os.environ['ANNTOOLS_BYTES_IO'].lower() in ('1', 'true', 'yes')) if ('ANNTOOLS_BYTES_IO' in os.environ) else False
+
   AWS_PROFILE_NAME = os.environ['AWS_PROFILE_NAME'] if ('AWS_PROFILE_NAME' in  os.environ) else None
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -34,80 +34,431 @@
 
 import sys
 import os
+import multiprocessing
+import shutil
+import tempfile
 import file_utils as fu
 import annotate as ann
+import intervals
+import profiling
+import scheduler
+import shards
+import sql_config
+import tabix
+import variantcache
+import vcfio
 
-def run(infile, format):
+""" Stages in the order the pipeline applies them """
+def pipelineStages(format='vcf'):
+    return [
+        ann.DbSnpStage(format=format),
+        ann.BigRefGeneStage(format=format),
+        ann.GenesStage(format=format, table='refGene', promoter_offset=500),
+        ann.CytobandStage(format=format, table='cytoBand'),
+        ann.GadAllStage(format=format, table='gadAll'),
+        ann.GwasCatalogStage(format=format, table='gwasCatalog'),
+        ann.MiRNAStage(format=format, table='targetScanS'),
+        ann.HugoStage(format=format, table='hugo'),
+        ann.CnvStage(format=format, table='dgv_Cnv'),
+        ann.CnvStage(format=format, table='abParts_IG_T_CelReceptors'),
+        ann.CnvStage(format=format, table='mcCarroll_Cnv'),
+        ann.CnvStage(format=format, table='conrad_Cnv'),
+        ann.SuperDupsStage(format=format, table='genomicSuperDups'),
+        ann.TfbsStage(table='tfbsConsSites'),
+    ]
+
+
+# Inputs at least this large load the overlap tables into memory instead of querying them per variant
+PRELOAD_MIN_BYTES = 4*1024*1024
+# Smaller inputs of at least this size merge-join the overlap tables chromosome by chromosome,
+# as long as the variants are sorted by position
+SWEEP_MIN_BYTES = 256*1024
+# With several workers, inputs with fewer variants are still annotated in a single process
+PARALLEL_MIN_VARIANTS = 20000
+
+
+""" Annotated file name: sample.vcf or sample.vcf.gz -> sample.annot.vcf, or sample.annot.vcf.gz with compress """
+def annotatedName(infile, compress=False):
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    name = (infile+'.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        name = name + '.gz'
+    return name
+
+
+def run(infile, format, fused=True, preload=None, sweep=None, workers=1, threads=1, pack=None, snpIndex=None, variantCache=None, bloomFilters=None, compress=False, binary=False):
 
     print("Running . . .")
+    job = profiling.JobProfile()
+
+    useReference(pack, snpIndex, bloomFilters)
+    ## a parallel job before may have left the cap at a worker's share
+    intervals.limitPartitions(intervals.PARTITION_MAX_ROWS)
+
+    if preload is None:
+        preload = vcfio.inputSize(infile) >= PRELOAD_MIN_BYTES
+    if sweep is None:
+        sweep = vcfio.inputSize(infile) >= SWEEP_MIN_BYTES
+
+    varCache = None
+    if fused and variantCache is not None:
+        varCache = variantcache.VariantCache(variantCache, sql_config.referenceStamp() + '|' + pipelineSignature(format))
+
+    outfile = annotatedName(infile, compress)
+    if fused and workers > 1:
+        stages = runParallel(infile, outfile, format, workers, preload=preload, sweep=sweep, threads=threads, varCache=varCache, binary=binary)
+    elif fused:
+        stages = runFused(infile, outfile, format, preload=preload, sweep=sweep, threads=threads, varCache=varCache, binary=binary)
+    elif compress or vcfio.isCompressed(infile):
+        raise ValueError('Staged annotation reads and writes plain VCF only: ' + infile)
+    else:
+        stages = runStaged(infile, format)
+    job.stop()
+    writeMetrics(infile, outfile, stages, job, varCache=varCache)
+
+
+""" Reads the reference tables from the pack at path pack, or from MySQL with None, resolves dbSNP from the
+    index snpIndex and skips the lookups the Bloom filters bloomFilters rule out (those of the pack by default).
+    Nothing set by an earlier job in the process carries over; what is already in use is kept as it is """
+def useReference(pack, snpIndex, bloomFilters):
+    sql_config.usePack(pack)
+    if bloomFilters is None and sql_config.pack is not None:
+        bloomFilters = sql_config.pack.filters()
+    if snpIndex != (ann.dbSnpIndex.path if ann.dbSnpIndex is not None else None):
+        ann.useDbSnpIndex(snpIndex)
+    if bloomFilters != (ann.bloomFilters.path if ann.bloomFilters is not None else None):
+        ann.useBloomFilters(bloomFilters)
+
+
+""" Reads the VCF once, passes every batch of variants through all stages in memory and writes the annotated file once """
+def runFused(infile, outfile, format, preload=False, sweep=False, threads=1, varCache=None, binary=False):
+    stages = pipelineStages(format=format)
+    annotateFile(infile, outfile, stages, preload=preload, sweep=sweep, threads=threads, varCache=varCache, binary=binary)
+    writeReport(stages, infile+'.count.log', varCache=varCache)
+    return stages
+
+
+""" What the variant cache stamp needs to know about the stages: the tables and settings behind their lookups,
+    and the dbSNP index in use """
+def pipelineSignature(format):
+    signature = format + ':' + ','.join([str(stage.cacheName()) for stage in pipelineStages(format=format)])
+    if ann.dbSnpIndex is not None:
+        ## dbSNP results cached from an index are only as current as the index
+        signature = signature + '|snpIndex:' + str(ann.dbSnpIndex.source)
+    return signature
+
+
+""" With threads > 1 the stages get a connection each and independent stages are looked up concurrently.
+    With a variant cache, variants annotated in earlier jobs only have their cached lookup results applied.
+    infile may be gzip or BGZF compressed, outfile is written as BGZF when it ends with .gz,
+    with a tabix index next to it. With binary, lines are read, split and written as bytes """
+def annotateFile(infile, outfile, stages, preload=False, sweep=False, threads=1, varCache=None, sep='\t', binary=False):
+    conn = None
+    sched = None
+    if threads < 2:
+        conn = sql_config.acquire()
+    fh = vcfio.openInput(infile, binary)
+    fh_out = vcfio.openOutput(outfile, binary)
+    indexer = outputIndexer(outfile)
+
+    try:
+        if varCache is not None:
+            varCache.open()
+        for stage in stages:
+            stage.open(conn)
+            if preload:
+                started = stage.profile.start()
+                stage.preload()
+                stage.profile.stop(started)
+            elif sweep:
+                stage.sweep()
+        if threads > 1:
+            sched = scheduler.StageScheduler(stages, threads)
+
+        for batch in ann.readBatches(fh, ann.BATCH_SIZE, sep=sep, inds=stages[0].inds, binary=binary):
+            variants = ann.batchVariants(batch)
+            if varCache is not None:
+                annotateCached(variants, stages, sched, varCache)
+            else:
+                annotateVariants(variants, stages, sched)
+            writeBatch(fh_out, batch, indexer)
+
+    finally:
+        if varCache is not None:
+            varCache.close()
+        if sched is not None:
+            sched.close()
+        for stage in stages:
+            stage.close()
+        if conn is not None:
+            sql_config.release(conn)
+        fh.close()
+        fh_out.close()
+    writeIndex(indexer, outfile)
+
+
+""" Tabix indexer of a BGZF output, None for plain output """
+def outputIndexer(outfile):
+    if outfile.endswith('.gz'):
+        return tabix.TabixIndexer()
+    return None
+
+
+def writeBatch(fh_out, batch, indexer):
+    if indexer is None:
+        ann.writeBatch(fh_out, batch)
+        return
+    for item in batch:
+        if isinstance(item, ann.Variant):
+            item = item.line()
+        indexer.writeLine(fh_out, item)
+
+
+def writeIndex(indexer, outfile):
+    if indexer is None:
+        return
+    if not indexer.write(outfile+'.tbi'):
+        print("Not indexing " + outfile + ": its variants are not sorted by position")
+        if fu.isExist(outfile+'.tbi'):
+            fu.delete(outfile+'.tbi')
+
+
+""" Looks up and applies every stage, returns the lookup results of each stage """
+def annotateVariants(variants, stages, sched):
+    if sched is not None:
+        return sched.annotateBatch(variants)
+    results = []
+    for stage in stages:
+        stageResults = stage.cachedLookupBatch(variants)
+        stage.applyBatch(variants, stageResults)
+        results.append(stageResults)
+    return results
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', tmpextout='.1' )
+
+def annotateCached(variants, stages, sched, varCache):
+    keys = [variantcache.variantKey(variant) for variant in variants]
+    found = varCache.getBatch(keys)
+    hits = [i for i, key in enumerate(keys) if key in found]
+    missed = [i for i, key in enumerate(keys) if key not in found]
+    varCache.hits = varCache.hits + len(hits)
+    varCache.misses = varCache.misses + len(missed)
+
+    if len(hits) > 0:
+        hitVariants = [variants[i] for i in hits]
+        for s, stage in enumerate(stages):
+            stage.applyBatch(hitVariants, [found[keys[i]][s] for i in hits])
+
+    if len(missed) > 0:
+        results = annotateVariants([variants[i] for i in missed], stages, sched)
+        items = {}
+        for j, i in enumerate(missed):
+            items[keys[i]] = [stageResults[j] for stageResults in results]
+        varCache.putBatch(list(items.items()))
+
+
+def writeReport(stages, logfile, varCache=None):
+    fh_log = open(logfile, 'w')
+    for stage in stages:
+        stage.report(fh_log)
+        stage.reportCache(fh_log)
+        stage.reportFilters(fh_log)
+        stage.reportProfile(fh_log)
+    if varCache is not None:
+        varCache.report(fh_log)
+    fh_log.close()
+
+
+""" Appends the totals of the job to the .count.log and writes the profile of every stage to the .metrics.json """
+def writeMetrics(infile, outfile, stages, job, varCache=None):
+    variants = stages[0].profile.variants if len(stages) > 0 else 0
+    bytesRead = profiling.fileSize(infile)
+    bytesWritten = profiling.fileSize(outfile) + profiling.fileSize(outfile+'.tbi')
+    fh_log = open(infile+'.count.log', 'a')
+    fh_log.write(profiling.jobLine(variants, job, bytesRead, bytesWritten))
+    fh_log.close()
+
+    metrics = {
+        'input': os.path.basename(infile),
+        'output': os.path.basename(outfile),
+        'variants': variants,
+        'wallTime': job.wallTime,
+        'cpuTime': job.cpu,
+        'bytesRead': bytesRead,
+        'bytesWritten': bytesWritten,
+        'variantsPerSecond': profiling.rate(variants, job.wallTime),
+        'variantCache': None if varCache is None else {'hits': varCache.hits, 'misses': varCache.misses},
+        'stages': [stage.metrics() for stage in stages],
+    }
+    profiling.writeMetrics(infile+'.metrics.json', metrics)
+
+
+""" Splits the VCF into chromosome shards, annotates them in a pool of worker processes
+    (each with its own connection) and merges the shards and their counters back in input order """
+def runParallel(infile, outfile, format, workers, preload=False, sweep=False, threads=1, varCache=None, binary=False):
+    plan = shards.planShards(infile, workers*shards.SHARDS_PER_WORKER, binary=binary)
+    if plan.variants < PARALLEL_MIN_VARIANTS or plan.count() < 2:
+        return runFused(infile, outfile, format, preload=preload, sweep=sweep, threads=threads, varCache=varCache, binary=binary)
+
+    workdir = tempfile.mkdtemp(prefix='shards.', dir=os.path.dirname(os.path.abspath(infile)))
+    try:
+        paths, layout, headers = shards.splitInput(infile, plan, workdir, binary=binary)
+        preloaded = None
+        if preload:
+            ## load the tables before forking, so the workers share them (see workerContext)
+            preloaded = preloadTables(format)
+
+        ## largest shards first, the small ones fill in the gaps at the end
+        jobs = sorted(paths, key=fu.fileSize, reverse=True)
+        pool = workerContext().Pool(processes=workers, initializer=initWorker, initargs=workerSettings(workers))
+        try:
+            results = pool.map(annotateShard, [(path, format, preload, sweep, threads, varCache, binary) for path in jobs], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        indexer = outputIndexer(outfile)
+        shards.mergeShards(outfile, layout, headers, [annotatedName(path) for path in paths], indexer=indexer, binary=binary)
+        writeIndex(indexer, outfile)
+
+        stages = pipelineStages(format=format)
+        if preloaded is not None:
+            ## the preload queries ran here, on stages of their own
+            for stage, profileCounters in zip(stages, preloaded):
+                stage.profile.addCounters(profileCounters)
+        for counters, cacheCounters in results:
+            for stage, stageCounters in zip(stages, counters):
+                stage.addCounters(stageCounters)
+            if varCache is not None:
+                varCache.hits = varCache.hits + cacheCounters[0]
+                varCache.misses = varCache.misses + cacheCounters[1]
+        writeReport(stages, infile+'.count.log', varCache=varCache)
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return stages
+
+
+""" Forked workers share the preloaded tables with the parent, whatever the default start method
+    of the platform; where there is no fork, initWorker sets the workers up on their own """
+def workerContext():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+""" The reference settings in effect in this process, for initWorker """
+def workerSettings(workers):
+    snpIndex = ann.dbSnpIndex.path if ann.dbSnpIndex is not None else None
+    bloomFilters = ann.bloomFilters.path if ann.bloomFilters is not None else None
+    ## the per-chromosome tables the workers load count against one cap for the job
+    return (sql_config.pack.path if sql_config.pack is not None else None, snpIndex, bloomFilters, max(1, intervals.PARTITION_MAX_ROWS // workers))
+
+
+""" Pool initializer: applies the parent's reference settings. A forked worker already has them and
+    keeps what it inherited; a spawned one starts from the module defaults and would read MySQL """
+def initWorker(pack, snpIndex, bloomFilters, partitionRows):
+    useReference(pack, snpIndex, bloomFilters)
+    intervals.limitPartitions(partitionRows)
+
+
+""" Pool worker: annotates one shard and returns the counters of its stages and of the variant cache """
+def annotateShard(job):
+    path, format, preload, sweep, threads, varCache, binary = job
+    stages = pipelineStages(format=format)
+    annotateFile(path, annotatedName(path), stages, preload=preload, sweep=sweep, threads=threads, varCache=varCache, binary=binary)
+    if varCache is None:
+        return [stage.counters() for stage in stages], None
+    return [stage.counters() for stage in stages], (varCache.hits, varCache.misses)
+
+
+""" Loads the tables of the stages that preload into this process; returns the profile counters of the stages """
+def preloadTables(format):
+    stages = pipelineStages(format=format)
+    conn = sql_config.acquire()
+    try:
+        for stage in stages:
+            stage.open(conn)
+            started = stage.profile.start()
+            stage.preload()
+            stage.profile.stop(started)
+            stage.close()
+    finally:
+        sql_config.release(conn)
+    return [stage.profile.counters() for stage in stages]
+
+
+""" Runs the stages one after another, each one reading and writing a full temporary copy of the file. Returns the stages run """
+def runStaged(infile, format):
+    stages = []
+
+    stages.append(ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', tmpextout='.1' ))
     #print("Done dbSNP")
     # Set numbering
     tmpextin=1
     tmpextout=2
 
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("Done BigRefGene ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.getGenes(vcf=infile, format='vcf', table='refGene', promoter_offset=500, tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("Done RefGene")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("cytoband ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("gadAll ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', table='gwasCatalog', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("GwasCatalog ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("miRNA")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', table='hugo', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("HUGO Gene Nomenclature Committee (HGNC) ")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("dgv_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='abParts_IG_T_CelReceptors', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("abParts_IG_T_CelReceptors")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='mcCarroll_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("mcCarroll_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='conrad_Cnv', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("conrad_Cnv")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', table='genomicSuperDups', tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("genomicSuperDups")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
 
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout))
+    stages.append(ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',tmpextin='.'+str(tmpextin), tmpextout='.'+str(tmpextout)))
     #print("addOverlapWithTfbsConsSites")
     tmpextin=tmpextin+1
     tmpextout=tmpextout+1
@@ -117,5 +468,6 @@ def run(infile, format):
         fu.delete(infile+'.'+ str(i))
 
     os.rename(infile+'.'+str(tmpextin), infile+'.annot')
-    finalout=(infile+'.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile+'.annot', finalout)
+    os.rename(infile+'.annot', annotatedName(infile))
+    return stages
+
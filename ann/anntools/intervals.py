@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+""" In-memory interval indexes of the UCSC overlap tables.
+
+    Both answer the stabbing query 'chromStart <= pos AND pos <= chromEnd'
+    locally instead of sending one SQL query per variant. An IntervalIndex
+    loads a whole table once per process; a SweepJoin reads only the
+    chromosomes of the job and merges them with coordinate-sorted variants.
+    Tables split into one table per chromosome are loaded with loadPartition
+    when a job first needs them, keeping only the selected columns in compact
+    arrays, and evicted under a cap on the rows held.
+"""
+
+import array
+import bisect
+import heapq
+import threading
+from collections import OrderedDict
+import sql_config
+
+try:
+    import numpy as np
+except ImportError:
+    ## without NumPy, batches are stabbed one position at a time
+    np = None
+
+
+def overlapBatch(positions, starts, ends, maxEnds):
+    """ Overlaps of many positions with one sorted set of intervals, as CSR arrays.
+
+        starts must be sorted and maxEnds is the running maximum of ends. The
+        intervals containing positions[i] are indices[offsets[i]:offsets[i+1]],
+        in start order. Only intervals that start at or before a position and
+        whose running max end reaches it are candidates, so a batch costs a few
+        array operations however many positions it has.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    n = len(positions)
+    hi = np.searchsorted(starts, positions, side='right')
+    lo = np.minimum(np.searchsorted(maxEnds, positions, side='left'), hi)
+    counts = hi - lo
+    owner = np.repeat(np.arange(n), counts)
+    firsts = np.cumsum(counts) - counts
+    candidates = lo[owner] + (np.arange(len(owner)) - firsts[owner])
+    keep = ends[candidates] >= positions[owner]
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owner[keep], minlength=n), out=offsets[1:])
+    return offsets, candidates[keep]
+
+
+class IntervalIndex(object):
+    """ Per-chromosome index of the [start, end] intervals of one table.
+
+        Intervals of a chromosome are split into tiers by length (powers of 4).
+        Each tier is sorted by start and keeps a running maximum of the ends, so
+        a query only looks at the intervals of the tier that start close enough
+        to the position to reach it, even when the table also has huge intervals.
+        Matches are returned in the order the rows were loaded, which is the
+        order MySQL returns them for the equivalent query. With NumPy the tiers
+        are arrays and stabBatch() resolves many positions at once.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.size = 0
+        self.pending = {}
+        self.chroms = {}
+        self.rows = []
+        self.columns = None
+
+    def add(self, chrom, start, end, row):
+        self.pending.setdefault(chrom, []).append((start, end, self.size))
+        self.rows.append(row)
+        self.size = self.size + 1
+
+    def build(self):
+        for chrom, intervals in self.pending.items():
+            tiers = {}
+            for interval in intervals:
+                tier = abs(interval[1] - interval[0]).bit_length() // 2
+                tiers.setdefault(tier, []).append(interval)
+
+            built = []
+            for tier in sorted(tiers):
+                intervals = sorted(tiers[tier])
+                starts = [i[0] for i in intervals]
+                ends = [i[1] for i in intervals]
+                maxEnds = []
+                maxEnd = None
+                for end in ends:
+                    if maxEnd is None or end > maxEnd:
+                        maxEnd = end
+                    maxEnds.append(maxEnd)
+                seqs = [i[2] for i in intervals]
+                if np is not None:
+                    starts, ends, maxEnds, seqs = [np.array(a, dtype=np.int64) for a in (starts, ends, maxEnds, seqs)]
+                built.append((starts, ends, maxEnds, seqs))
+            self.chroms[chrom] = built
+        self.pending = {}
+
+    def stab(self, chrom, pos):
+        """ Rows whose interval contains pos, in load order """
+        hits = []
+        for starts, ends, maxEnds, seqs in self.chroms.get(chrom, ()):
+            hi = bisect.bisect_right(starts, pos)
+            lo = bisect.bisect_left(maxEnds, pos, 0, hi)
+            for j in range(lo, hi):
+                if pos <= ends[j]:
+                    hits.append(int(seqs[j]))
+        hits.sort()
+        return [self.rows[seq] for seq in hits]
+
+    def stabBatch(self, chrom, positions):
+        """ Rows whose interval contains each of the positions, in load order """
+        tiers = self.chroms.get(chrom, ())
+        if np is None or len(tiers) == 0:
+            return [self.stab(chrom, pos) for pos in positions]
+
+        n = len(positions)
+        owners = []
+        seqs = []
+        for starts, ends, maxEnds, tierSeqs in tiers:
+            offsets, indices = overlapBatch(positions, starts, ends, maxEnds)
+            owners.append(np.repeat(np.arange(n), np.diff(offsets)))
+            seqs.append(tierSeqs[indices])
+        owner = np.concatenate(owners)
+        seq = np.concatenate(seqs)
+        ## hits of all tiers, by position and then load order
+        order = np.lexsort((seq, owner))
+        seq = seq[order].tolist()
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=n)))).tolist()
+
+        rows = self.rows
+        return [[rows[s] for s in seq[offsets[i]:offsets[i+1]]] for i in range(0, n)]
+
+
+_indexes = {}
+
+def loadIndex(conn, table, chromCol='chrom', startCol='chromStart', endCol='chromEnd'):
+    """ Returns the index of the table, loading it on first use in this process """
+    index = _indexes.get(table)
+    if index is None:
+        index = IntervalIndex(table)
+        cursor = sql_config.streamCursor(conn)
+        cursor.execute('select * from ' + table + ';')
+        names = [str(d[0]) for d in cursor.description]
+        index.columns = names
+        chromInd = names.index(chromCol)
+        startInd = names.index(startCol)
+        endInd = names.index(endCol)
+        for row in cursor:
+            index.add(row[chromInd], int(row[startInd]), int(row[endInd]), row)
+        cursor.close()
+        index.build()
+        _indexes[table] = index
+    return index
+
+
+class CompactRows(object):
+    """ Rows of a partition held column by column instead of as a tuple each: the coordinates in
+        64-bit arrays and the other columns as lists of shared values (names repeat a lot) """
+
+    def __init__(self, columns, coordCols):
+        self.values = []
+        self.shared = []
+        for name in columns:
+            if name in coordCols:
+                self.values.append(array.array('q'))
+                self.shared.append(None)
+            else:
+                self.values.append([])
+                self.shared.append({})
+
+    def append(self, row):
+        for value, values, shared in zip(row, self.values, self.shared):
+            if shared is None:
+                value = int(value)
+            else:
+                value = shared.setdefault(value, value)
+            values.append(value)
+
+    def __getitem__(self, seq):
+        return tuple([values[seq] for values in self.values])
+
+    def __len__(self):
+        return len(self.values[0]) if len(self.values) > 0 else 0
+
+
+# Rows of the per-chromosome tables kept in memory by a process, across its jobs; past it the least recently used
+# tables are evicted. driver.run sets it again for every job, and the worker processes of a parallel job get an
+# equal share of it each (limitPartitions)
+PARTITION_MAX_ROWS = 2000000
+
+_partitions = OrderedDict()
+_partitionRows = [0]
+_partitionMaxRows = [PARTITION_MAX_ROWS]
+_partitionLock = threading.Lock()
+
+def limitPartitions(maxRows):
+    """ Caps the rows of the per-chromosome tables this process keeps at maxRows """
+    with _partitionLock:
+        _partitionMaxRows[0] = maxRows
+        evictPartitions()
+
+def evictPartitions():
+    ## the table loaded last stays, even on its own above the cap
+    while _partitionRows[0] > _partitionMaxRows[0] and len(_partitions) > 1:
+        oldTable, oldIndex = _partitions.popitem(last=False)
+        _partitionRows[0] = _partitionRows[0] - oldIndex.size
+
+def loadPartition(conn, table, columns, startCol='chromStart', endCol='chromEnd'):
+    """ Returns the index of one table of a table split by chromosome, with only columns kept
+        in the rows. The whole table is indexed under its own name, stab it with the table name """
+    with _partitionLock:
+        index = _partitions.get(table)
+        if index is not None:
+            _partitions.move_to_end(table)
+            return index
+
+        index = IntervalIndex(table)
+        index.rows = CompactRows(columns, (startCol, endCol))
+        cursor = sql_config.streamCursor(conn)
+        cursor.execute('select ' + ', '.join(columns) + ' from ' + table + ';')
+        index.columns = list(columns)
+        startInd = index.columns.index(startCol)
+        endInd = index.columns.index(endCol)
+        for row in cursor:
+            index.add(table, int(row[startInd]), int(row[endInd]), row)
+        cursor.close()
+        index.build()
+
+        _partitions[table] = index
+        _partitionRows[0] = _partitionRows[0] + index.size
+        evictPartitions()
+        return index
+
+
+def clearIndexes():
+    """ Drops the tables loaded by loadIndex and loadPartition, when the reference they came from is no longer in use """
+    with _partitionLock:
+        _indexes.clear()
+        _partitions.clear()
+        _partitionRows[0] = 0
+
+
+class SweepJoin(object):
+    """ Sort-merge join of coordinate-sorted variants with one table.
+
+        The rows of a chromosome are read in one sequential scan when the
+        variants reach it and swept in start order, keeping the intervals that
+        still reach the current position in a heap keyed by end. Every table is
+        read once per job. Once a variant comes out of order (a lower position,
+        or a chromosome seen before) stab() returns None and the caller has to
+        fall back to querying.
+    """
+
+    def __init__(self, conn, table, chromCol='chrom', startCol='chromStart', endCol='chromEnd'):
+        self.conn = conn
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.inOrder = True
+        self.done = set()
+        self.chrom = None
+        self.lastPos = None
+        self.rows = []
+        self.next = 0
+        self.active = []
+
+    def load(self, chrom):
+        cursor = sql_config.streamCursor(self.conn)
+        cursor.execute('select * from ' + self.table + ' where ' + self.chromCol + '=%s;', (chrom,))
+        names = [str(d[0]) for d in cursor.description]
+        startInd = names.index(self.startCol)
+        endInd = names.index(self.endCol)
+        rows = []
+        for row in cursor:
+            rows.append((int(row[startInd]), int(row[endInd]), len(rows), row))
+        cursor.close()
+        rows.sort(key=lambda r: (r[0], r[2]))
+
+        if self.chrom is not None:
+            self.done.add(self.chrom)
+        self.chrom = chrom
+        self.lastPos = None
+        self.rows = rows
+        self.next = 0
+        self.active = []
+
+    def stab(self, chrom, pos):
+        """ Rows whose interval contains pos in table order, or None if the variants are not sorted """
+        if not self.inOrder:
+            return None
+        if chrom != self.chrom:
+            if chrom in self.done:
+                self.inOrder = False
+                return None
+            self.load(chrom)
+        elif pos < self.lastPos:
+            self.inOrder = False
+            return None
+        self.lastPos = pos
+
+        rows = self.rows
+        while self.next < len(rows) and rows[self.next][0] <= pos:
+            start, end, seq, row = rows[self.next]
+            heapq.heappush(self.active, (end, seq, row))
+            self.next = self.next + 1
+        while len(self.active) > 0 and self.active[0][0] < pos:
+            heapq.heappop(self.active)
+
+        hits = sorted(self.active, key=lambda a: a[1])
+        return [hit[2] for hit in hits]
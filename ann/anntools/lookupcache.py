@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+""" In-process LRU caches of lookup results, one per table.
+
+    The caches live as long as the process, so loci that come back within a
+    job, or in the next job handled by the same process, are not queried again.
+    Each cache is bounded by weight: an entry weighs one plus the number of rows
+    it holds, so a few loci with many rows cannot crowd out everything else.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Weight (entries plus rows) each table's cache holds before evicting; 0 turns caching off
+CACHE_MAX_WEIGHT = 200000
+
+MISSING = object()
+
+
+class LruCache(object):
+
+    def __init__(self, maxWeight=CACHE_MAX_WEIGHT):
+        self.maxWeight = maxWeight
+        self.weight = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Cached value of key, or MISSING """
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, weight=1):
+        """ Caches value, returns the number of entries evicted to make room """
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.weight = self.weight - old[1]
+            if weight > self.maxWeight:
+                return evicted
+            self.entries[key] = (value, weight)
+            self.weight = self.weight + weight
+            while self.weight > self.maxWeight:
+                oldKey, (oldValue, oldWeight) = self.entries.popitem(last=False)
+                self.weight = self.weight - oldWeight
+                evicted = evicted + 1
+        return evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+
+_caches = {}
+_lock = threading.Lock()
+
+def getCache(name):
+    """ The cache of a table (or table variant), None when caching is off """
+    if CACHE_MAX_WEIGHT <= 0:
+        return None
+    with _lock:
+        cache = _caches.get(name)
+        if cache is None:
+            cache = LruCache(CACHE_MAX_WEIGHT)
+            _caches[name] = cache
+        return cache
+
+def clearAll():
+    with _lock:
+        for cache in _caches.values():
+            cache.clear()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+""" Per-stage profiles of a job, for the .count.log and the .metrics.json.
+
+    Every stage keeps a StageProfile. It times the stage's lookups and applies
+    (wall clock and CPU time of the thread running them, so stages looked up
+    concurrently are told apart) and counts the variants it annotated. The
+    statements the stage runs and the rows they return are counted by a
+    ProfiledConnection around its connection, which catches the preload and
+    sweep queries along with the per-variant ones. Stages do no file I/O in the
+    fused pipeline, so bytes read and written are only set per stage by the
+    staged pipeline; the job totals always have them.
+"""
+
+import json
+import os
+import time
+
+
+class StageProfile(object):
+
+    def __init__(self):
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.variants = 0
+        self.queries = 0
+        self.rows = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def start(self):
+        return (time.perf_counter(), time.thread_time())
+
+    def stop(self, started):
+        self.wallTime = self.wallTime + time.perf_counter() - started[0]
+        self.cpuTime = self.cpuTime + time.thread_time() - started[1]
+
+    def counters(self):
+        return (self.wallTime, self.cpuTime, self.variants, self.queries, self.rows, self.bytesRead, self.bytesWritten)
+
+    def addCounters(self, counters):
+        wallTime, cpuTime, variants, queries, rows, bytesRead, bytesWritten = counters
+        self.wallTime = self.wallTime + wallTime
+        self.cpuTime = self.cpuTime + cpuTime
+        self.variants = self.variants + variants
+        self.queries = self.queries + queries
+        self.rows = self.rows + rows
+        self.bytesRead = self.bytesRead + bytesRead
+        self.bytesWritten = self.bytesWritten + bytesWritten
+
+
+class ProfiledConnection(object):
+    """ Hands out cursors that count into profile; conn is the connection to give back to the pool """
+
+    def __init__(self, conn, profile):
+        self.conn = conn
+        self.profile = profile
+
+    def cursor(self, *args):
+        return ProfiledCursor(self.conn.cursor(*args), self.profile)
+
+
+class ProfiledCursor(object):
+
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.profile = profile
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, sql, args=None):
+        self.profile.queries = self.profile.queries + 1
+        return self.cursor.execute(sql, args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.profile.rows = self.profile.rows + 1
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.profile.rows = self.profile.rows + len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.profile.rows = self.profile.rows + 1
+            yield row
+
+    def close(self):
+        self.cursor.close()
+
+
+class JobProfile(object):
+    """ Wall clock and CPU time of a whole job, the CPU time of worker processes included once they are joined """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.startedCpu = self.cpuTime()
+        self.wallTime = 0.0
+        self.cpu = 0.0
+
+    def cpuTime(self):
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def stop(self):
+        self.wallTime = time.perf_counter() - self.started
+        self.cpu = self.cpuTime() - self.startedCpu
+
+
+""" Size of path, 0 if it does not exist """
+def fileSize(path):
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+""" Variants per second over seconds, 0 when nothing was timed """
+def rate(variants, seconds):
+    if seconds <= 0:
+        return 0.0
+    return variants/seconds
+
+
+""" The .count.log line of one stage """
+def stageLine(name, profile, cacheHits):
+    line = "Profile " + str(name) + ": " + str(profile.variants) + " variants, " + str(round(profile.wallTime, 3)) + " s wall, " + str(round(profile.cpuTime, 3)) + " s CPU, " + str(profile.queries) + " queries, " + str(profile.rows) + " rows, " + str(cacheHits) + " cache hits"
+    if profile.bytesRead > 0 or profile.bytesWritten > 0:
+        line = line + ", " + str(profile.bytesRead) + " bytes read, " + str(profile.bytesWritten) + " bytes written"
+    return line + "\n"
+
+
+""" The .count.log line of the whole job """
+def jobLine(variants, job, bytesRead, bytesWritten):
+    return "Profile job: " + str(variants) + " variants, " + str(round(job.wallTime, 3)) + " s wall, " + str(round(job.cpu, 3)) + " s CPU, " + str(bytesRead) + " bytes read, " + str(bytesWritten) + " bytes written, " + str(int(rate(variants, job.wallTime))) + " variants/s\n"
+
+
+def writeMetrics(path, metrics):
+    fh = open(path, 'w')
+    json.dump(metrics, fh, indent=2, sort_keys=True)
+    fh.write('\n')
+    fh.close()
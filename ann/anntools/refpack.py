@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+""" Annotation packs: offline snapshots of the reference tables.
+
+    A pack is a directory with a manifest.json (format, version stamp, source
+    and row counts), a read-only SQLite file holding every table the stages
+    query, in the order MySQL returned the rows, and the Bloom filters of the
+    exact-match tables (bloomfilter.py). With a pack in use
+    (sql_config.usePack) sql_config hands out PackConnections, which take the
+    stages' statements as they are, so the stages annotate without a MySQL
+    server and every annotator can scale out on its own copy of the files.
+
+    Export a pack from the database in config.txt with
+        python refpack.py <pack_dir> [stamp] [bloom_false_positive_rate]
+"""
+
+import datetime
+import decimal
+import json
+import os
+import sqlite3
+import sys
+import time
+import annotate as ann
+import sql_config
+
+PACK_FORMAT = 1
+PACK_DB = 'reference.db'
+PACK_MANIFEST = 'manifest.json'
+# Directory of the Bloom filters (bloomfilter.py) built with the pack
+PACK_BLOOM = 'bloom'
+
+# Rows inserted per transaction while exporting
+EXPORT_CHUNK = 10000
+
+OVERLAP_TABLES = ['cytoBand', 'gadAll', 'gwasCatalog', 'hugo', 'dgv_Cnv', 'abParts_IG_T_CelReceptors',
+                  'mcCarroll_Cnv', 'conrad_Cnv', 'genomicSuperDups', 'targetScanS']
+
+""" Tables of a pack, with the columns to index for the lookups of the stages """
+def packTables():
+    tables = [
+        ('dbSNP', ('CHR', 'POS')),
+        ('chrom_pos_equal_base', ('CHR', 'start')),
+        ('chrom_pos_equal_nobase', ('CHR', 'start')),
+        ('chrom_pos_unequal', ('CHR', 'start')),
+        ('refGene', ('chrom', 'txStart')),
+        ('cpgIslandExt', ('chrom', 'chromStart')),
+    ]
+    for table in OVERLAP_TABLES:
+        if table == 'gadAll':
+            tables.append((table, ('chromosome', 'chromStart')))
+        elif table == 'gwasCatalog':
+            tables.append((table, ('chrom', 'chromEnd')))
+        else:
+            tables.append((table, ('chrom', 'chromStart')))
+    for chrom in ann.TfbsStage.allowed_chrom:
+        tables.append(('tfbsConsSites' + chrom, ('chromStart',)))
+    return tables
+
+
+""" Value as stored in the pack: str() of it gives the same text as str() of the MySQL value """
+def packValue(value):
+    if isinstance(value, (decimal.Decimal, datetime.date, datetime.time, datetime.timedelta)):
+        return str(value)
+    return value
+
+
+""" Creates table with the columns names in the pack database, returns its insert statement """
+def createTable(db, table, names):
+    ## no column types, values are kept as MySQL returned them; strings compare case-insensitively as in MySQL
+    db.execute('create table ' + table + ' (' + ', '.join(['"' + n + '" COLLATE NOCASE' for n in names]) + ');')
+    return 'insert into ' + table + ' values (' + ','.join(['?'] * len(names)) + ');'
+
+
+def indexTable(db, table, indexCols):
+    db.execute('create index ' + table + '_lookup on ' + table + ' (' + ', '.join(['"' + c + '"' for c in indexCols]) + ');')
+    db.commit()
+
+
+def exportTable(conn, db, table, indexCols):
+    cursor = sql_config.streamCursor(conn)
+    cursor.execute('select * from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    insert = createTable(db, table, names)
+
+    rows = 0
+    chunk = []
+    for row in cursor:
+        chunk.append([packValue(v) for v in row])
+        if len(chunk) >= EXPORT_CHUNK:
+            db.executemany(insert, chunk)
+            rows = rows + len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        db.executemany(insert, chunk)
+        rows = rows + len(chunk)
+    cursor.close()
+    db.commit()
+
+    indexTable(db, table, indexCols)
+    return {'rows': rows, 'columns': names}
+
+
+""" Exports the reference tables of the configured database into a pack at path,
+    with Bloom filters at false positive rate bloomFpr """
+def exportPack(path, stamp=None, bloomFpr=None):
+    if stamp is None:
+        stamp = str(sql_config.db) + '-' + time.strftime('%Y%m%d')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    tmp = os.path.join(path, PACK_DB + '.tmp')
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    conn = sql_config.acquire()
+    db = sqlite3.connect(tmp)
+    try:
+        db.execute('PRAGMA journal_mode=OFF;')
+        db.execute('PRAGMA synchronous=OFF;')
+        tables = {}
+        for table, indexCols in packTables():
+            print('Exporting ' + table)
+            tables[table] = exportTable(conn, db, table, indexCols)
+        db.execute('ANALYZE;')
+        db.commit()
+    finally:
+        db.close()
+        sql_config.release(conn)
+
+    os.rename(tmp, os.path.join(path, PACK_DB))
+    return finishPack(path, stamp, {'host': sql_config.host, 'db': sql_config.db}, tables, bloomFpr)
+
+
+""" Writes the manifest of the pack database at path and builds its Bloom filters """
+def finishPack(path, stamp, source, tables, bloomFpr=None):
+    manifest = {
+        'format': PACK_FORMAT,
+        'stamp': stamp,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': source,
+        'tables': tables,
+    }
+    fh = open(os.path.join(path, PACK_MANIFEST), 'w')
+    json.dump(manifest, fh, indent=2, sort_keys=True)
+    fh.close()
+
+    ## built from the pack itself, so they are stamped with it
+    import bloomfilter
+    pack = openPack(path)
+    conn = pack.connect()
+    try:
+        bloomfilter.buildFilters(os.path.join(path, PACK_BLOOM), bloomFpr if bloomFpr is not None else bloomfilter.BLOOM_FPR, conn=conn, source='pack:' + str(stamp))
+    finally:
+        conn.close()
+    return manifest
+
+
+class Pack(object):
+    """ An exported pack, opened read-only """
+
+    def __init__(self, path):
+        self.path = path
+        fh = open(os.path.join(path, PACK_MANIFEST))
+        self.manifest = json.load(fh)
+        fh.close()
+        if self.manifest.get('format') != PACK_FORMAT:
+            raise ValueError('Unsupported annotation pack format ' + str(self.manifest.get('format')) + ' in ' + path)
+        self.stamp = self.manifest['stamp']
+        self.db = os.path.join(path, PACK_DB)
+        self.size = os.path.getsize(self.db)
+
+    def connect(self):
+        return PackConnection(self)
+
+    def filters(self):
+        """ Directory of the Bloom filters built with the pack, or None """
+        path = os.path.join(self.path, PACK_BLOOM)
+        if os.path.isdir(path):
+            return path
+        return None
+
+
+def openPack(path):
+    return Pack(path)
+
+
+class PackConnection(object):
+    """ Read-only connection to a pack with the parts of the pymysql connection API the stages use """
+
+    def __init__(self, pack):
+        self.pack = pack
+        self.db = sqlite3.connect('file:' + pack.db + '?mode=ro', uri=True, check_same_thread=False)
+        ## map the whole file, pages are shared with the other annotators through the page cache
+        self.db.execute('PRAGMA mmap_size=' + str(pack.size) + ';')
+        self.open = True
+
+    def cursor(self, cursorclass=None):
+        return PackCursor(self.db.cursor())
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        if self.open:
+            self.db.close()
+            self.open = False
+
+
+class PackCursor(object):
+    """ Runs the stages' %s statements on the pack, rows come back in the order they were exported """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.description = None
+
+    def execute(self, sql, args=None):
+        sql = sql.strip().rstrip(';').replace('%s', '?')
+        if ' union all ' in sql:
+            ## every part of a union in its own export order, then the order by of the whole union
+            sql, sep, orderBy = sql.partition(' order by ')
+            sql = ' union all '.join(['select * from (' + part + ' order by rowid)' for part in sql.split(' union all ')]) + sep + orderBy + ';'
+        else:
+            sql = sql + ' order by rowid;'
+        if args is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql, tuple(args))
+        self.description = self.cursor.description
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python refpack.py <pack_dir> [stamp] [bloom_false_positive_rate]')
+        sys.exit(1)
+    manifest = exportPack(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None, float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print('Exported pack ' + manifest['stamp'] + ' to ' + sys.argv[1])
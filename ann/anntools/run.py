@@ -67,23 +67,32 @@ if __name__ == '__main__':
   # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/dynamodb.html
   if len(sys.argv) > 1:
     with Timer():
-      driver.run(sys.argv[1], 'vcf')
+      driver.run(sys.argv[1], 'vcf', workers=Config.ANNTOOLS_WORKERS, threads=Config.ANNTOOLS_STAGE_THREADS, pack=Config.ANNTOOLS_PACK, snpIndex=Config.ANNTOOLS_SNP_INDEX, variantCache=Config.ANNTOOLS_VARIANT_CACHE, bloomFilters=Config.ANNTOOLS_BLOOM_FILTERS, compress=Config.ANNTOOLS_BGZF_OUTPUT, binary=Config.ANNTOOLS_BYTES_IO)
 
     results_bucket = Config.AWS_S3_RESULTS_BUCKET
     fullFilePath = sys.argv[2]
     basePath, userName, job_id, inputFile, myName, user_email = sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6], sys.argv[7], sys.argv[8]
-    resultFile = inputFile.replace('.', '.annot.')
+    resultFile = driver.annotatedName(inputFile, Config.ANNTOOLS_BGZF_OUTPUT)
     resultPath = f'{basePath}/jobs/{userName}/{job_id}/{resultFile}'
     resultKey = f'{myName}/{userName}/{job_id}/{resultFile}'
     logFile = f'{inputFile}.count.log'
     logPath = f'{basePath}/jobs/{userName}/{job_id}/{logFile}'
     logKey = f'{myName}/{userName}/{job_id}/{logFile}'
+    metricsFile = f'{inputFile}.metrics.json'
+    metricsPath = f'{basePath}/jobs/{userName}/{job_id}/{metricsFile}'
+    metricsKey = f'{myName}/{userName}/{job_id}/{metricsFile}'
 
     # Ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
     s3_client = boto3.client('s3', region_name=Config.AWS_REGION_NAME)
     try:
       response = s3_client.upload_file(Filename=resultPath, Bucket=results_bucket, Key=resultKey, Callback=ProgressPercentage(resultPath))
       response = s3_client.upload_file(Filename=logPath, Bucket=results_bucket, Key=logKey, Callback=ProgressPercentage(logPath))
+      # tabix index of a compressed result, stored next to it so regions can be fetched with byte-range reads
+      if os.path.exists(f'{resultPath}.tbi'):
+        response = s3_client.upload_file(Filename=f'{resultPath}.tbi', Bucket=results_bucket, Key=f'{resultKey}.tbi', Callback=ProgressPercentage(f'{resultPath}.tbi'))
+      # per-stage profile of the job (driver.writeMetrics)
+      if os.path.exists(metricsPath):
+        response = s3_client.upload_file(Filename=metricsPath, Bucket=results_bucket, Key=metricsKey, Callback=ProgressPercentage(metricsPath))
     except ClientError as e:
       logging.error(e)
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Table.update_item
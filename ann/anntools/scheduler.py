@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+""" Runs the lookups of independent stages concurrently.
+
+    Every stage declares the variant columns and INFO keys it reads and the ones
+    it writes. A stage depends on the earlier stages that write something it
+    reads (getGenes reads the positionType written by getBigRefGene), and its
+    lookups start once those stages have been applied to the batch. Everything
+    else is looked up at the same time, each stage on its own connection.
+
+    The results are applied in the main thread and in pipeline order, so the
+    INFO fragments come out in the same order as with the stages run one by one.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def dependencies(stages):
+    """ For each stage, the earlier stages writing something it reads """
+    deps = []
+    for i, stage in enumerate(stages):
+        reads = set(stage.reads)
+        deps.append([j for j in range(0, i) if reads.intersection(stages[j].writes)])
+    return deps
+
+
+class StageScheduler(object):
+
+    def __init__(self, stages, threads):
+        self.stages = stages
+        self.deps = dependencies(stages)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def annotateBatch(self, batch):
+        """ Looks up and applies every stage, returns the lookup results of each stage """
+        stages = self.stages
+        futures = [None] * len(stages)
+        results = []
+        applied = 0
+        while applied < len(stages):
+            ## start every lookup whose dependencies have been applied
+            for i, stage in enumerate(stages):
+                if futures[i] is None and all([j < applied for j in self.deps[i]]):
+                    futures[i] = self.executor.submit(stage.cachedLookupBatch, batch)
+            results.append(futures[applied].result())
+            stages[applied].applyBatch(batch, results[applied])
+            applied = applied + 1
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+""" Splitting a VCF into shards that can be annotated in parallel, and merging them back.
+
+    Each chromosome is a shard; chromosomes holding more than their share of the
+    variants are split further into position ranges of about the same number of
+    variants. The merge puts every annotated line back where it was in the input.
+"""
+
+import array
+import bisect
+import os
+import annotate as ann
+import vcfio
+
+# Shards planned per worker, so a slow shard does not leave the other workers idle
+SHARDS_PER_WORKER = 2
+
+
+class ShardPlan(object):
+    """ Maps a variant (chrom, pos) to a shard number """
+
+    def __init__(self):
+        self.variants = 0
+        self.boundaries = {}
+        self.ids = {}
+
+    def add(self, chrom, boundaries):
+        self.boundaries[chrom] = boundaries
+        for i in range(0, len(boundaries)+1):
+            self.ids[(chrom, i)] = len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def shardOf(self, chrom, pos):
+        return self.ids[(chrom, bisect.bisect_right(self.boundaries[chrom], pos))]
+
+
+def planShards(infile, nshards, sep='\t', binary=False):
+    """ Reads the input once to count the variants of each chromosome and plan nshards balanced shards """
+    positions = {}
+    chroms = []
+    if binary:
+        sep = sep.encode('utf-8')
+    fh = vcfio.openInput(infile, binary)
+    for line in fh:
+        line = line.strip()
+        if not ann.isHeader(line):
+            fields = line.split(sep, 2)
+            chrom = fields[0].strip()
+            if chrom not in positions:
+                positions[chrom] = array.array('l')
+                chroms.append(chrom)
+            positions[chrom].append(int(fields[1]))
+    fh.close()
+
+    plan = ShardPlan()
+    plan.variants = sum([len(p) for p in positions.values()])
+    target = max(1, -(-plan.variants // max(1, nshards)))
+    for chrom in chroms:
+        chromPositions = positions[chrom]
+        boundaries = []
+        if len(chromPositions) > target:
+            chromPositions = sorted(chromPositions)
+            parts = -(-len(chromPositions) // target)
+            for i in range(1, parts):
+                boundary = chromPositions[(i * len(chromPositions)) // parts]
+                if len(boundaries) == 0 or boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+        plan.add(chrom, boundaries)
+    return plan
+
+
+def splitInput(infile, plan, workdir, sep='\t', binary=False):
+    """ Writes one VCF per shard into workdir, as bytes with binary (plan has to be planned the same way).
+
+        Returns the shard paths, the input layout (shard number of each line, -1
+        for header lines) and the header lines, which is what mergeShards needs.
+    """
+    base = os.path.basename(infile).replace('.gz', '').replace('.vcf', '')
+    paths = [os.path.join(workdir, base + '.shard' + str(i) + '.vcf') for i in range(0, plan.count())]
+    outs = [vcfio.openOutput(path, binary) for path in paths]
+    layout = array.array('i')
+    headers = []
+    newline = b'\n' if binary else '\n'
+    if binary:
+        sep = sep.encode('utf-8')
+
+    fh = vcfio.openInput(infile, binary)
+    for line in fh:
+        stripped = line.strip()
+        if ann.isHeader(stripped):
+            headers.append(stripped)
+            layout.append(-1)
+            for out in outs:
+                out.write(stripped+newline)
+        else:
+            fields = stripped.split(sep, 2)
+            shard = plan.shardOf(fields[0].strip(), int(fields[1]))
+            outs[shard].write(stripped+newline)
+            layout.append(shard)
+    fh.close()
+    for out in outs:
+        out.close()
+    return paths, layout, headers
+
+
+def mergeShards(outfile, layout, headers, annotated, indexer=None, binary=False):
+    """ Writes the annotated shards into outfile in the order of the original input, through indexer if given """
+    shards = [vcfio.openInput(path, binary) for path in annotated]
+    fh_out = vcfio.openOutput(outfile, binary)
+    newline = b'\n' if binary else '\n'
+    nextHeader = 0
+    for shard in layout:
+        if shard < 0:
+            line = headers[nextHeader]+newline
+            nextHeader = nextHeader + 1
+        else:
+            line = shards[shard].readline()
+            while ann.isHeader(line.strip()):
+                line = shards[shard].readline()
+        if indexer is None:
+            fh_out.write(line)
+        else:
+            indexer.writeLine(fh_out, line[:-1])
+    fh_out.close()
+    for shard in shards:
+        shard.close()
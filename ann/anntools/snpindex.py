@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+""" Memory-mapped dbSNP index, resolving a whole batch of variants with NumPy.
+
+    The dbSNP rows of one variant class are stored as sorted arrays: a key
+    encoding chromosome and position, the code of the reference allele, and the
+    offsets of the rsID and the GMAF in two byte blobs. A batch is looked up with
+    np.searchsorted and the reference allele and its complement are checked in
+    the same vectorized pass. Rows of a position stay in table order, as the
+    query returns them.
+
+    The files are memory-mapped, so the annotators of a host (and the workers
+    of a job) share one copy through the page cache. Build an index with
+        python snpindex.py <index_dir> [pack_dir]
+
+    Needs NumPy, which the rest of anntools does not.
+"""
+
+import array
+import json
+import mmap
+import os
+import sys
+import numpy as np
+import annotate as ann
+import sql_config
+
+INDEX_FORMAT = 1
+INDEX_META = 'meta.json'
+
+# Chromosome code in the high bits of the key, position in the low 32 bits
+POS_BITS = 32
+
+
+def encodeKeys(chromCodes, positions):
+    return (np.asarray(chromCodes, dtype=np.int64) << POS_BITS) | np.asarray(positions, dtype=np.int64)
+
+
+class BlobWriter(object):
+    """ Appends strings to a blob file, returning their [start, end) offsets """
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.size = 0
+
+    def add(self, value):
+        data = value.encode('utf-8')
+        self.fh.write(data)
+        start = self.size
+        self.size = self.size + len(data)
+        return start, self.size
+
+    def close(self):
+        self.fh.close()
+
+
+""" Builds the index of the dbSNP rows of varclass from the configured database (or pack) into path """
+def buildIndex(path, varclass='SNV'):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    chroms = {}
+    refs = {}
+    gmafs = {}
+    keys = array.array('q')
+    refCodes = array.array('i')
+    rsidOffsets = array.array('q')
+    gmafOffsets = array.array('q')
+    rsidBlob = BlobWriter(os.path.join(path, 'rsids.bin'))
+    gmafBlob = BlobWriter(os.path.join(path, 'gmafs.bin'))
+
+    conn = sql_config.acquire()
+    try:
+        cursor = sql_config.streamCursor(conn)
+        cursor.execute('select * from dbSNP where INFO = %s;', (varclass,))
+        names = [str(d[0]) for d in cursor.description]
+        chrInd = names.index('CHR')
+        posInd = names.index('POS')
+        refInd = names.index('REF')
+        for row in cursor:
+            chrom = ann.sqlKey(row[chrInd])
+            ref = ann.sqlKey(row[refInd])
+            ## rsID and GMAF are the columns DbSnpStage.apply reads
+            gmaf = str(row[7])
+            keys.append((chroms.setdefault(chrom, len(chroms)) << POS_BITS) | int(row[posInd]))
+            refCodes.append(refs.setdefault(ref, len(refs)))
+            rsidOffsets.extend(rsidBlob.add(str(row[3])))
+            if gmaf not in gmafs:
+                gmafs[gmaf] = gmafBlob.add(gmaf)
+            gmafOffsets.extend(gmafs[gmaf])
+        cursor.close()
+    finally:
+        sql_config.release(conn)
+        rsidBlob.close()
+        gmafBlob.close()
+
+    keys = np.frombuffer(keys, dtype=np.int64)
+    ## stable, so the rows of a position keep the table order
+    order = np.argsort(keys, kind='stable')
+    np.save(os.path.join(path, 'keys.npy'), keys[order])
+    np.save(os.path.join(path, 'refs.npy'), np.frombuffer(refCodes, dtype=np.int32)[order])
+    np.save(os.path.join(path, 'rsid_offsets.npy'), np.frombuffer(rsidOffsets, dtype=np.int64).reshape(-1, 2)[order])
+    np.save(os.path.join(path, 'gmaf_offsets.npy'), np.frombuffer(gmafOffsets, dtype=np.int64).reshape(-1, 2)[order])
+
+    meta = {
+        'format': INDEX_FORMAT,
+        'varclass': varclass,
+        ## checked against the reference in use before the index is used, as the Bloom filters are
+        'source': sql_config.referenceStamp(),
+        'rows': len(keys),
+        'chroms': sorted(chroms, key=chroms.get),
+        'refs': sorted(refs, key=refs.get),
+    }
+    fh = open(os.path.join(path, INDEX_META), 'w')
+    json.dump(meta, fh, indent=2)
+    fh.close()
+    return meta
+
+
+def mapBlob(path):
+    fh = open(path, 'rb')
+    try:
+        if os.path.getsize(path) == 0:
+            return b''
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fh.close()
+
+
+class SnpIndex(object):
+    """ An index built by buildIndex, memory-mapped read-only """
+
+    def __init__(self, path):
+        fh = open(os.path.join(path, INDEX_META))
+        meta = json.load(fh)
+        fh.close()
+        if meta.get('format') != INDEX_FORMAT:
+            raise ValueError('Unsupported dbSNP index format ' + str(meta.get('format')) + ' in ' + path)
+        self.path = path
+        self.varclass = meta['varclass']
+        self.source = meta['source']
+        self.chromCodes = dict([(c, i) for i, c in enumerate(meta['chroms'])])
+        self.refCodes = dict([(r, i) for i, r in enumerate(meta['refs'])])
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.refs = np.load(os.path.join(path, 'refs.npy'), mmap_mode='r')
+        self.rsidOffsets = np.load(os.path.join(path, 'rsid_offsets.npy'), mmap_mode='r')
+        self.gmafOffsets = np.load(os.path.join(path, 'gmaf_offsets.npy'), mmap_mode='r')
+        self.rsids = mapBlob(os.path.join(path, 'rsids.bin'))
+        self.gmafs = mapBlob(os.path.join(path, 'gmafs.bin'))
+
+    def lookupBatch(self, variants):
+        """ variants are (chr, pos, ref) as the stage queries them; returns the (rsID, GMAF) matches of each """
+        n = len(variants)
+        results = [[] for i in range(0, n)]
+        if n == 0 or len(self.keys) == 0:
+            return results
+
+        chroms = np.empty(n, dtype=np.int64)
+        positions = np.empty(n, dtype=np.int64)
+        refs = np.empty(n, dtype=np.int32)
+        compRefs = np.empty(n, dtype=np.int32)
+        for i, (chr, pos, ref) in enumerate(variants):
+            chroms[i] = self.chromCodes.get(ann.sqlKey(chr), -1)
+            positions[i] = pos
+            refs[i] = self.refCodes.get(ann.sqlKey(ref), -1)
+            compRefs[i] = self.refCodes.get(ann.sqlKey(ann.getComplementary(ref)), -1)
+
+        known = (chroms >= 0) & (positions >= 0) & (positions < (1 << POS_BITS))
+        query = encodeKeys(np.where(known, chroms, 0), np.where(known, positions, 0))
+        lo = np.searchsorted(self.keys, query, side='left')
+        hi = np.searchsorted(self.keys, query, side='right')
+        counts = np.where(known, hi - lo, 0)
+        total = int(counts.sum())
+        if total == 0:
+            return results
+
+        ## one candidate row per (variant, row at its position), then both strands at once
+        owner = np.repeat(np.arange(n), counts)
+        firsts = np.cumsum(counts) - counts
+        candidates = lo[owner] + (np.arange(total) - firsts[owner])
+        candidateRefs = self.refs[candidates]
+        match = ((candidateRefs == refs[owner]) & (refs[owner] >= 0)) | ((candidateRefs == compRefs[owner]) & (compRefs[owner] >= 0))
+
+        for variant, row in zip(owner[match].tolist(), candidates[match].tolist()):
+            rsidStart, rsidEnd = self.rsidOffsets[row]
+            gmafStart, gmafEnd = self.gmafOffsets[row]
+            results[variant].append((self.rsids[rsidStart:rsidEnd].decode('utf-8'), self.gmafs[gmafStart:gmafEnd].decode('utf-8')))
+        return results
+
+
+def openIndex(path):
+    return SnpIndex(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python snpindex.py <index_dir> [pack_dir]')
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        sql_config.usePack(sys.argv[2])
+    meta = buildIndex(sys.argv[1])
+    print('Indexed ' + str(meta['rows']) + ' dbSNP rows into ' + sys.argv[1])
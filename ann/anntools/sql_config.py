@@ -33,8 +33,13 @@
 ################################################################################
 
 #import MySQLdb
+import hashlib
+import os
+import threading
+import time
 import pymysql
 import file_utils as fu
+import lookupcache
 import file_utils as fu
 
 def load_config(filename='config.txt'):
@@ -54,8 +59,180 @@ user = config[1]
 passwd = config[2]
 db = config[3]
 port = int(config[4])
+# Version of the reference in the MySQL database: an optional sixth line, to be changed whenever the tables are reloaded
+referenceVersion = config[5] if len(config) > 5 else None
+
+# Annotation pack the connections read from instead of the MySQL server, see refpack.py
+pack = None
 
 def conn2annotator():
+    if pack is not None:
+        return pack.connect()
     #conn = MySQLdb.connect (host = host, user = user, passwd = passwd, db = db, port = port)
     conn = pymysql.connect (host = host, user = user, passwd = passwd, db = db, port = port)
     return conn
+
+""" Placeholders for n bound parameters, for IN lists """
+def placeholders(n):
+    return ','.join(['%s'] * n)
+
+""" Unbuffered cursor, rows are streamed from the server instead of being fetched all at once """
+def streamCursor(conn):
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
+# Most connections the pool keeps open at once in one process
+POOL_MAX_SIZE = 16
+# Idle connections are pinged (and reconnected if stale) before they are handed out again
+POOL_PING_AFTER = 30
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 300
+
+class ConnectionPool(object):
+    """ Connections to the annotator database reused across stages and jobs.
+
+        acquire() hands out an idle connection, or opens a new one while fewer
+        than maxsize are open, or waits for one to be released. A connection
+        that sat idle for more than POOL_PING_AFTER seconds is pinged first and
+        reconnected if the server dropped it. release() ends the read
+        transaction, so the next user does not see an old snapshot, and puts the
+        connection back; a broken connection is closed and forgotten instead.
+        Connections never cross a fork, a child process starts an empty pool.
+    """
+
+    def __init__(self, maxsize=POOL_MAX_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.inUse = 0
+
+    def acquire(self, timeout=POOL_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.lock:
+            if self.pid != os.getpid():
+                ## the parent's sockets are not ours to use or to close
+                self.reset()
+            while len(self.idle) == 0 and self.inUse >= self.maxsize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('No free connection in the pool of ' + str(self.maxsize) + ' after ' + str(timeout) + 's')
+                self.lock.wait(remaining)
+            if len(self.idle) > 0:
+                conn, lastUsed = self.idle.pop()
+            else:
+                conn, lastUsed = None, None
+            self.inUse = self.inUse + 1
+
+        try:
+            if conn is None:
+                conn = conn2annotator()
+            elif time.time() - lastUsed > POOL_PING_AFTER:
+                conn.ping(reconnect=True)
+        except Exception:
+            self.discard(None)
+            raise
+        return conn
+
+    def release(self, conn):
+        if self.pid != os.getpid():
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        with self.lock:
+            self.idle.append((conn, time.time()))
+            self.inUse = self.inUse - 1
+            self.lock.notify()
+
+    def discard(self, conn):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self.lock:
+            self.inUse = self.inUse - 1
+            self.lock.notify()
+
+    def closeAll(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+                return
+            idle = self.idle
+            self.idle = []
+        for conn, lastUsed in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+_pool = ConnectionPool()
+
+""" Pooled connection, hand it back with release() when done """
+def acquire():
+    return _pool.acquire()
+
+def release(conn):
+    _pool.release(conn)
+
+# Table with the version of the reference in a version column, for databases whose config.txt declares none
+REFERENCE_VERSION_TABLE = 'reference_version'
+
+""" Version of the reference tables: the pack stamp, or for MySQL the version in config.txt, else the one in
+    the reference_version table, else a CHECKSUM TABLE of every table the stages read (which scans them all).
+    The table update times in information_schema are no version: MySQL 8 caches them for up to a day and
+    InnoDB forgets them on restart """
+def referenceStamp():
+    if pack is not None:
+        return 'pack:' + str(pack.stamp)
+    prefix = 'mysql:' + str(host) + '/' + str(db) + ':'
+    if referenceVersion is not None:
+        return prefix + 'version:' + str(referenceVersion)
+    import refpack
+    conn = acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('select table_name from information_schema.tables where table_schema=%s and table_name=%s;', (db, REFERENCE_VERSION_TABLE))
+        if cursor.fetchone() is not None:
+            cursor.execute('select version from ' + REFERENCE_VERSION_TABLE + ';')
+            versions = sorted([str(row[0]) for row in cursor.fetchall()])
+            if len(versions) > 0:
+                cursor.close()
+                return prefix + 'version:' + ','.join(versions)
+        cursor.execute('checksum table ' + ', '.join([table for table, indexCols in refpack.packTables()]) + ';')
+        digest = hashlib.md5()
+        for row in cursor.fetchall():
+            digest.update(('\t'.join([str(x) for x in row]) + '\n').encode('utf-8'))
+        cursor.close()
+    finally:
+        release(conn)
+    return prefix + 'checksum:' + digest.hexdigest()
+
+""" Reads the reference tables from the annotation pack at path from now on, or from MySQL again with None """
+def usePack(path):
+    global pack
+    import annotate, intervals, refpack
+    previous = pack
+    if path is None:
+        pack = None
+    else:
+        pack = refpack.openPack(path)
+    if previous is None and pack is None:
+        return
+    if previous is not None and pack is not None and previous.path == pack.path and previous.stamp == pack.stamp:
+        ## the same pack again, what was loaded from it is still valid
+        return
+    ## connections to, lookups cached from and indexes built from the previous source must not be used again
+    _pool.closeAll()
+    lookupcache.clearAll()
+    intervals.clearIndexes()
+    annotate.useDbSnpIndex(None)
+    annotate.useBloomFilters(None)
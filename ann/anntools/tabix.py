@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+""" Tabix (.tbi) index of a BGZF compressed VCF, built while the VCF is written.
+
+    Every record written through writeLine() is added with the virtual
+    offsets (vcfio.BgzfWriter.tell) of its start and end, to the UCSC bins of
+    its [pos-1, pos-1+len(REF)) interval, extended to the END in INFO for
+    symbolic and structural variants, and to the 16 kb linear index. The
+    result is the index tabix -p vcf writes, so tabix, htslib and pysam can
+    fetch a region of the annotated VCF with a few byte-range reads instead of
+    reading the whole file. The index is only valid for output sorted by
+    coordinate, with each chromosome in one run; for anything else
+    (or positions past the 512 Mb tabix supports) no index is written.
+"""
+
+import struct
+import vcfio
+
+# 16 kb windows of the linear index, 6 levels of bins as in the SAM/tabix specification
+MIN_SHIFT = 14
+MAX_POS = 1 << 29
+# Bin holding the offsets and record counts of a reference, written by htslib and optional for readers
+META_BIN = 37450
+
+
+def reg2bin(beg, end):
+    """ Smallest bin containing [beg, end), 0-based """
+    end = end - 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def infoEnd(info):
+    """ END of an INFO column (1-based, inclusive, so the 0-based end of the interval), 0 without one """
+    for entry in info.split(';'):
+        if entry.startswith('END='):
+            value = entry[4:]
+            return int(value) if value.isdigit() else 0
+    return 0
+
+
+class RefIndex(object):
+
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+        self.first = None
+        self.last = None
+        self.records = 0
+
+    def add(self, beg, end, vstart, vend):
+        chunks = self.bins.setdefault(reg2bin(beg, end), [])
+        if len(chunks) > 0 and chunks[-1][1] == vstart:
+            ## contiguous with the previous record of the bin
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        lastWindow = (end - 1) >> MIN_SHIFT
+        while len(self.linear) <= lastWindow:
+            self.linear.append(None)
+        for window in range(beg >> MIN_SHIFT, lastWindow + 1):
+            if self.linear[window] is None:
+                self.linear[window] = vstart
+        if self.first is None:
+            self.first = vstart
+        self.last = vend
+        self.records = self.records + 1
+
+    def pack(self):
+        data = [struct.pack('<i', len(self.bins) + 1)]
+        for bin in sorted(self.bins):
+            chunks = self.bins[bin]
+            data.append(struct.pack('<Ii', bin, len(chunks)))
+            for vstart, vend in chunks:
+                data.append(struct.pack('<QQ', vstart, vend))
+        data.append(struct.pack('<IiQQQQ', META_BIN, 2, self.first, self.last, self.records, 0))
+
+        ## empty windows get the offset of the window before them (the first record for leading ones), as htslib fills them
+        linear = []
+        previous = self.first
+        for offset in self.linear:
+            if offset is None:
+                offset = previous
+            linear.append(offset)
+            previous = offset
+        data.append(struct.pack('<i', len(linear)))
+        data.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+        return b''.join(data)
+
+
+class TabixIndexer(object):
+    """ Collects the index of the records written through writeLine(); write() saves it if the output was sorted """
+
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.chrom = None
+        self.lastPos = 0
+        self.valid = True
+
+    def writeLine(self, fh_out, line):
+        """ Writes one line of the VCF, text or bytes, indexing it unless it is a header line """
+        start = fh_out.tell()
+        if isinstance(line, bytes):
+            fh_out.write(line+b'\n')
+            header = line.startswith(b'#')
+        else:
+            fh_out.write(line+'\n')
+            header = line.startswith('#')
+        if self.valid and not header:
+            self.add(line, start, fh_out.tell())
+
+    def add(self, line, vstart, vend):
+        binary = isinstance(line, bytes)
+        ## INFO is only split out when it can hold an END
+        columns = 8 if (b'END=' if binary else 'END=') in line else 4
+        fields = line.split(b'\t' if binary else '\t', columns)[:columns]
+        if binary:
+            fields = [field.decode('utf-8') for field in fields]
+        if len(fields) < 4 or not fields[1].isdigit():
+            ## not a record tabix could index
+            self.valid = False
+            return
+        chrom = fields[0]
+        pos = int(fields[1])
+        beg = max(pos - 1, 0)
+        end = beg + max(len(fields[3]), 1)
+        if len(fields) == 8:
+            ## symbolic and structural variants reach to their END, as tabix -p vcf indexes them
+            end = max(end, infoEnd(fields[7]))
+        if chrom != self.chrom:
+            if chrom in self.refs:
+                ## the chromosome came up before, so the output is not sorted
+                self.valid = False
+                return
+            self.names.append(chrom)
+            self.refs[chrom] = RefIndex()
+            self.chrom = chrom
+            self.lastPos = 0
+        if pos < self.lastPos or end > MAX_POS:
+            self.valid = False
+            return
+        self.lastPos = pos
+        self.refs[chrom].add(beg, end, vstart, vend)
+
+    def write(self, path):
+        """ Writes the index to path, returns False (writing nothing) when the output cannot be indexed """
+        if not self.valid:
+            return False
+        names = b''.join([name.encode('utf-8') + b'\0' for name in self.names])
+        ## VCF preset: sequence in column 1, position in column 2, end from REF, '#' header lines
+        data = [b'TBI\1', struct.pack('<8i', len(self.names), 2, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for name in self.names:
+            data.append(self.refs[name].pack())
+        fh = vcfio.BgzfWriter(path)
+        fh.write(b''.join(data))
+        fh.close()
+        return True
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+""" Parsed refGene transcripts, cached per process.
+
+    getGenes used to decode and split exonStarts/exonEnds and int() every exon
+    of every overlapping transcript for every variant, then scan all exons
+    linearly; transcripts like TTN's have hundreds. A Transcript holds the
+    bounds, strand and exon coordinates as ints, is built once per transcript
+    row and kept in the process-wide LRU cache (lookupcache.py), and finds the
+    exons containing a position by bisection. Promoter windows are computed
+    once per transcript and promoter offset.
+"""
+
+from bisect import bisect_left, bisect_right
+import lookupcache
+
+
+def exonList(value):
+    """ Exon coordinates of a refGene blob, as ints; int() parses the bytes without decoding them """
+    if isinstance(value, bytes):
+        return [int(x) for x in value.split(b',') if x != b'']
+    return [int(x) for x in str(value).split(',') if x != '']
+
+
+def isSorted(values):
+    return all([values[i] <= values[i+1] for i in range(0, len(values)-1)])
+
+
+class Transcript(object):
+    """ A refGene row: tx and cds bounds, strand and exons """
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = exonList(row[9])[:self.exonCount]
+        self.exonEnds = exonList(row[10])[:self.exonCount]
+        ## refGene exons are ordered and disjoint; anything else is scanned
+        self.ordered = isSorted(self.exonStarts) and isSorted(self.exonEnds)
+        self.promoters = {}
+
+    def exonsAt(self, pos):
+        """ Indices of the exons with start <= pos <= end, in exon order """
+        if self.ordered:
+            return range(bisect_left(self.exonEnds, pos), bisect_right(self.exonStarts, pos))
+        return [e for e in range(0, len(self.exonStarts)) if self.exonStarts[e] <= pos <= self.exonEnds[e]]
+
+    def promoterWindow(self, offset):
+        """ [start, end] of the offset bases upstream of the transcription start, None for an unknown strand """
+        window = self.promoters.get(offset, False)
+        if window is False:
+            window = None
+            if self.strand == '+':
+                window = (self.txStart - offset, self.txStart)
+            elif self.strand == '-':
+                window = (self.txEnd, self.txEnd + offset)
+            self.promoters[offset] = window
+        return window
+
+    def exonNumber(self, e):
+        """ Number of exon e counted in the direction of transcription """
+        if self.strand == '-':
+            return self.exonCount - e
+        return e + 1
+
+
+""" Transcript of a refGene row, from the cache of table when cached """
+def transcript(table, row):
+    cache = lookupcache.getCache('transcripts:' + str(table))
+    if cache is None:
+        return Transcript(row)
+    ## everything the model is built from
+    key = tuple(row[1:11])
+    model = cache.get(key)
+    if model is lookupcache.MISSING:
+        model = Transcript(row)
+        cache.put(key, model)
+    return model
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+""" Persistent cache of annotated variants, shared by the jobs of a node.
+
+    A SQLite file maps a (chrom, pos, ref, alt) to the lookup
+    results of every stage of the pipeline, so a variant seen in an earlier job
+    skips all lookups and only has the results applied. Every row carries the
+    stamp of the job that wrote it, made of the reference version and the
+    stage list, and a job only reads rows of its own stamp: jobs on different
+    references can share the file, and a job still running when the reference
+    changes cannot hand its results to the jobs after it. Past maxBytes rows
+    of other stamps are evicted first, then the least recently used variants.
+
+    Lookup results are cached rather than the final INFO text: the text and
+    the .count.log counters also depend on the INFO the variant came with.
+"""
+
+import hashlib
+import pickle
+import sqlite3
+import time
+import zlib
+
+CACHE_FORMAT = 2
+# Size the cache is kept under
+CACHE_MAX_BYTES = 2*1024*1024*1024
+# Evictions go down to this fraction of the maximum, so they do not run on every batch
+EVICT_TO = 0.9
+# Keys per select, below the SQLite parameter limit
+SELECT_CHUNK = 500
+
+
+""" Key of a variant: the columns as the stages read them, some of which query the chromosome as written """
+def variantKey(variant):
+    return variant.chrom + ':' + variant.posText + ':' + variant.ref + ':' + variant.alt
+
+
+class VariantCache(object):
+    """ Opened in every process that annotates (see open()), so it can be handed to pool workers unopened """
+
+    def __init__(self, path, stamp, maxBytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.stamp = stamp
+        ## rows carry a digest of the stamp rather than the stamp itself
+        self.stampKey = hashlib.md5(stamp.encode('utf-8')).hexdigest()[:16]
+        self.maxBytes = maxBytes
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('create table if not exists meta (k TEXT PRIMARY KEY, v TEXT);')
+
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            row = self.db.execute("select v from meta where k='format';").fetchone()
+            if row is None or row[0] != str(CACHE_FORMAT):
+                ## written by another version of the cache, start over
+                self.db.execute('drop table if exists variants;')
+                self.db.execute('delete from meta;')
+                self.db.execute("insert into meta values ('format', ?);", (str(CACHE_FORMAT),))
+                self.db.execute("insert into meta values ('bytes', '0');")
+            self.db.execute('create table if not exists variants (stamp TEXT, key TEXT, value BLOB, size INTEGER, used REAL, PRIMARY KEY (stamp, key));')
+            self.db.execute('create index if not exists variants_used on variants (used);')
+            self.db.execute('COMMIT;')
+        except Exception:
+            self.db.execute('ROLLBACK;')
+            raise
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def getBatch(self, keys):
+        """ Cached results of the keys found, by key """
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), SELECT_CHUNK):
+            chunk = unique[i:i+SELECT_CHUNK]
+            marks = ','.join(['?'] * len(chunk))
+            for key, value in self.db.execute('select key, value from variants where stamp=? and key in (' + marks + ');', [self.stampKey] + chunk):
+                found[key] = pickle.loads(zlib.decompress(value))
+            if len(found) > 0:
+                self.db.execute('update variants set used=? where stamp=? and key in (' + marks + ');', [time.time(), self.stampKey] + chunk)
+        return found
+
+    def putBatch(self, items):
+        """ Caches (key, results) pairs and evicts if the cache grew past maxBytes """
+        now = time.time()
+        added = 0
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            for key, results in items:
+                value = zlib.compress(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+                cursor = self.db.execute('insert or ignore into variants values (?, ?, ?, ?, ?);', (self.stampKey, key, value, len(value), now))
+                if cursor.rowcount > 0:
+                    added = added + len(value)
+            self.db.execute("update meta set v = cast(v as integer) + ? where k='bytes';", (added,))
+            size = int(self.db.execute("select v from meta where k='bytes';").fetchone()[0])
+            if size > self.maxBytes:
+                self.evict(size)
+            self.db.execute('COMMIT;')
+        except Exception:
+            self.db.execute('ROLLBACK;')
+            raise
+
+    def evict(self, size):
+        """ Rows of other stamps go first, this job cannot use them; then the least recently used """
+        target = int(self.maxBytes * EVICT_TO)
+        stale = self.db.execute('select coalesce(sum(size), 0) from variants where stamp != ?;', (self.stampKey,)).fetchone()[0]
+        if stale > 0:
+            self.db.execute('delete from variants where stamp != ?;', (self.stampKey,))
+            size = size - stale
+        while size > target:
+            rows = self.db.execute('select stamp, key, size from variants order by used limit 1000;').fetchall()
+            if len(rows) == 0:
+                break
+            for stamp, key, rowSize in rows:
+                self.db.execute('delete from variants where stamp=? and key=?;', (stamp, key))
+                size = size - rowSize
+                if size <= target:
+                    break
+        self.db.execute("update meta set v = ? where k='bytes';", (str(max(size, 0)),))
+
+    def report(self, fh_log):
+        fh_log.write("Variant cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses\n")
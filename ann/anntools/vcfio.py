@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+""" Reading and writing plain, gzip and BGZF compressed VCFs.
+
+    Inputs are recognized by the gzip magic bytes rather than the name, and
+    read as a stream; BGZF files are multi-member gzip, which gzip reads as is.
+    Outputs named .gz are written as BGZF: independent deflate blocks of at
+    most 64 KB, ending with the empty EOF block, as bgzip and htslib write
+    them. Each block starts a new gzip member, so any gzip reader can read the
+    output and tabix-style indexes can address it by virtual offset.
+"""
+
+import gzip
+import os
+import struct
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Uncompressed bytes per BGZF block, so that even incompressible data fits in a 64 KB block
+BGZF_BLOCK_SIZE = 0xff00
+# Deflate level of the BGZF blocks
+BGZF_LEVEL = 6
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Rough size of a compressed VCF once decompressed, to size jobs by their data
+GZIP_RATIO = 6
+
+# Buffer of binary file handles; the default of a few KB costs a system call for every long line
+BINARY_BUFFER = 1024*1024
+
+
+def isCompressed(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return magic == GZIP_MAGIC
+
+
+def openInput(path, binary=False):
+    """ Text file handle of a plain or gzip/BGZF compressed VCF, a binary one with binary """
+    if isCompressed(path):
+        return gzip.open(path, 'rb' if binary else 'rt')
+    if binary:
+        return open(path, 'rb', BINARY_BUFFER)
+    return open(path)
+
+
+def openOutput(path, binary=False):
+    """ File handle writing BGZF when path ends with .gz, plain text (bytes with binary) otherwise """
+    if path.endswith('.gz'):
+        return BgzfWriter(path)
+    if binary:
+        return open(path, 'wb', BINARY_BUFFER)
+    return open(path, 'w')
+
+
+def inputSize(path):
+    """ Size of the VCF data of path, estimated for compressed files """
+    size = os.path.getsize(path)
+    if isCompressed(path):
+        return size * GZIP_RATIO
+    return size
+
+
+class BgzfWriter(object):
+    """ Writes text as BGZF blocks. tell() is the virtual offset of the next byte written:
+        the file offset of its block shifted left 16 bits, plus its offset within the block """
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.blockStart = 0
+        self.buffer = bytearray()
+
+    def write(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        self.buffer.extend(text)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.writeBlock(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def tell(self):
+        return (self.blockStart << 16) | len(self.buffer)
+
+    def writeBlock(self, data):
+        compressor = zlib.compressobj(BGZF_LEVEL, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        ## header with the BC extra field holding the block size - 1, then deflate data, CRC32 and length
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(cdata) + 25)
+        block = header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+        self.fh.write(block)
+        self.blockStart = self.blockStart + len(block)
+
+    def close(self):
+        if self.fh is None:
+            return
+        if len(self.buffer) > 0:
+            self.writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        self.fh = None